@@ -0,0 +1,134 @@
+# MIT License
+#
+# Copyright (c) 2024 carpaty https://github.com/carpaty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# -*- coding: utf-8 -*-
+
+"""
+In-process fakes for the benchmarks
+"""
+
+import asyncio
+
+
+class FakeBot:
+    """
+    Telegram bot that records messages instead of sending them.
+
+    :ivar sent: Sent messages as (chat_id, text)
+    :vartype sent: list[tuple]
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    async def initialize(self):
+        """
+        Nothing to prepare.
+        """
+
+    async def shutdown(self):
+        """
+        Nothing to release.
+        """
+
+    async def send_message(self, chat_id, text, **kwargs):  # pylint: disable=unused-argument
+        """
+        Record a message.
+
+        :param chat_id: Chat ID
+        :type chat_id: int | str
+        :param text: Text message
+        :type text: str
+        """
+        self.sent.append((chat_id, text))
+
+
+async def _serve_http(reader, writer):
+    try:
+        while True:
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 2\r\n\r\nok")
+            await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _serve_tcp(reader, writer):
+    try:
+        await reader.read()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def listen(count, http=False, host="0.0.0.0"):
+    """
+    Start local listeners on free ports.
+
+    :param count: Number of listeners
+    :type count: int
+    :param http: Answer every HTTP request with 200 OK, defaults to plain TCP
+    :type http: bool, optional
+    :param host: Address to bind, defaults to all addresses
+    :type host: str, optional
+    :return: Servers and their ports
+    :rtype: tuple[list[asyncio.Server], list[int]]
+    """
+    servers = [await asyncio.start_server(_serve_http if http else _serve_tcp, host, 0) for _ in range(count)]
+    return servers, [server.sockets[0].getsockname()[1] for server in servers]
+
+
+async def close(servers):
+    """
+    Stop local listeners.
+
+    :param servers: Servers returned by `listen`
+    :type servers: list[asyncio.Server]
+    """
+    for server in servers:
+        server.close()
+    await asyncio.gather(*(server.wait_closed() for server in servers))
+
+
+def menu_tree(sections, subsections, buttons):
+    """
+    Build a synthetic menu tree in the menu.yaml layout.
+
+    :param sections: Top-level menu entries
+    :type sections: int
+    :param subsections: Submenus of every section
+    :type subsections: int
+    :param buttons: Inline buttons of every submenu
+    :type buttons: int
+    :return: Menu tree
+    :rtype: dict
+    """
+    return {
+        f"Section {i}": {
+            f"Menu {i}.{j}": [
+                {'name': f"Button {i}.{j}.{k}", 'call': f"call_{i}_{j}_{k}", 'desc': f"Description {i}.{j}.{k}"}
+                for k in range(buttons)]
+            for j in range(subsections)}
+        for i in range(sections)}
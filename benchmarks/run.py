@@ -0,0 +1,335 @@
+# MIT License
+#
+# Copyright (c) 2024 carpaty https://github.com/carpaty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the bot's hot paths
+
+Runs offline: storage is a temporary SQLite database, Telegram is a fake bot,
+monitored sites and hosts are local listeners. Results are printed as JSON.
+
+Usage: python benchmarks/run.py [--quick] [--repeat N] [--output results.json]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import importlib.machinery
+import importlib.util
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import fakes
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+WORKDIR = tempfile.mkdtemp(prefix="itb-bench-")
+
+os.environ.setdefault('STORAGE_BACKEND', 'sqlite')
+os.environ.setdefault('SQLITE_PATH', os.path.join(WORKDIR, 'bench.sqlite3'))
+os.environ.setdefault('TG_GLOBAL_RATE', '1000000')
+os.environ.setdefault('TG_CHAT_RATE', '1000000')
+shutil.copy(os.path.join(SRC, "menu.yaml.example"), os.path.join(WORKDIR, "menu.yaml"))
+os.chdir(WORKDIR)
+sys.path.insert(0, SRC)
+
+# pylint: disable=wrong-import-position
+import callbacks  # noqa: E402
+import db  # noqa: E402
+import menu  # noqa: E402
+import utils  # noqa: E402
+
+MENU_SIZES = {'small': (3, 3, 4), 'medium': (10, 10, 5), 'large': (30, 30, 10)}
+PORTS = (100, 1000)
+TARGETS = ((100, 10), (1000, 100))
+QUICK = {'menu': ('small', 'medium'), 'ports': (100,), 'targets': ((100, 10),)}
+
+
+def load_calls():
+    """
+    Import the example calls module.
+
+    :return: button_func module
+    :rtype: module
+    """
+    path = os.path.join(SRC, "calls", "button_func.py.example")
+    loader = importlib.machinery.SourceFileLoader("button_func", path)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+
+def result(name, params, ops, timings):
+    """
+    Summarize the timings of a benchmark.
+
+    :param name: Benchmark name
+    :type name: str
+    :param params: Benchmark parameters
+    :type params: dict
+    :param ops: Operations in one run
+    :type ops: int
+    :param timings: Duration of every run, seconds
+    :type timings: list[float]
+    :return: Result with seconds per operation
+    :rtype: dict
+    """
+    per_op = [t / ops for t in timings]
+    return {
+        'name': name,
+        'params': params,
+        'ops': ops,
+        'runs': len(timings),
+        'min': min(per_op),
+        'median': statistics.median(per_op),
+        'mean': statistics.fmean(per_op),
+        'max': max(per_op),
+    }
+
+
+async def timed(func, repeat):
+    """
+    Time a coroutine function.
+
+    :param func: Coroutine function without arguments
+    :type func: callable
+    :param repeat: Number of runs
+    :type repeat: int
+    :return: Duration of every run, seconds
+    :rtype: list[float]
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await func()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def use_menu(tree):
+    """
+    Replace the loaded menu with a compiled tree.
+
+    :param tree: Menu tree
+    :type tree: dict
+    """
+    index = utils.compile_menu(tree)
+    index['digest'] = hashlib.sha1(json.dumps(tree).encode()).hexdigest()
+    utils.MENU = index
+
+
+async def bench_menu(size, repeat):
+    """
+    Benchmark menu navigation, callback query routing and description lookups.
+
+    :param size: Menu size name from `MENU_SIZES`
+    :type size: str
+    :param repeat: Number of runs
+    :type repeat: int
+    :return: Results
+    :rtype: list[dict]
+    """
+    tree = fakes.menu_tree(*MENU_SIZES[size])
+    use_menu(tree)
+    labels = list(utils.MENU['nodes'])
+    calls = list(utils.MENU['calls'])
+    params = {'menu': size, 'nodes': len(labels), 'calls': len(calls)}
+    menu.markups()
+
+    async def navigate():
+        for label in labels:
+            await menu.gen_menu(1, label)
+        await menu.gen_menu(1, '\U00002B05 Back')
+
+    async def handled(update, context):  # pylint: disable=unused-argument
+        pass
+
+    callbacks.routes.clear()
+    callbacks.route(handled, *calls)
+    updates = [SimpleNamespace(callback_query=SimpleNamespace(data=call)) for call in calls]
+
+    async def dispatch():
+        for update in updates:
+            await callbacks.dispatch(update, None)
+
+    async def menu_desc():
+        for call in calls:
+            utils.menu_desc(call)
+
+    return [
+        result('gen_menu', params, len(labels) + 1, await timed(navigate, repeat)),
+        result('dispatch', params, len(calls), await timed(dispatch, repeat)),
+        result('menu_desc', params, len(calls), await timed(menu_desc, repeat)),
+    ]
+
+
+async def bench_scan(calls, ports, repeat):
+    """
+    Benchmark `nmap_host` against local listeners.
+
+    Half of the ports (at most 200) are listening, the other half are closed.
+
+    :param calls: button_func module
+    :type calls: module
+    :param ports: Number of scanned ports
+    :type ports: int
+    :param repeat: Number of runs
+    :type repeat: int
+    :return: Result
+    :rtype: dict
+    """
+    servers, open_ports = await fakes.listen(min(ports // 2, 200), host="127.0.0.1")
+    closed = ports - len(open_ports)
+    port_list = ",".join(map(str, open_ports)) + f",{65535 - closed + 1}-65535"
+    try:
+        timings = await timed(lambda: calls.nmap_host("127.0.0.1", port_list), repeat)
+    finally:
+        await fakes.close(servers)
+    return result('nmap_host', {'ports': ports, 'open': len(open_ports)}, 1, timings)
+
+
+def seed(sql, sites, hosts, ports):
+    """
+    Replace the monitored sites and hosts, spread over ten users.
+
+    :param sql: Custom DB of the calls module
+    :type sql: button_func.Sql
+    :param sites: Site URLs
+    :type sites: list[str]
+    :param hosts: Host addresses
+    :type hosts: list[str]
+    :param ports: Ports expected open on every host
+    :type ports: str
+    """
+    client = sql.client
+    for kind in ("Sites", "Hosts", "Monitor"):
+        for entity in client.query(kind=kind).fetch():
+            client.delete(entity.key)
+    for i, site in enumerate(sites):
+        sql.qinsert_site("Sites", i % 10, site)
+    for i, host in enumerate(hosts):
+        sql.qinsert_host("Hosts", i % 10, host, ports, "open")
+
+
+async def bench_worker(calls, sites, hosts, repeat):
+    """
+    Benchmark a full `worker()` cycle with every target due.
+
+    Sites are served by a local HTTP listener, hosts are loopback addresses
+    with listening and closed ports.
+
+    :param calls: button_func module
+    :type calls: module
+    :param sites: Number of monitored sites
+    :type sites: int
+    :param hosts: Number of monitored hosts
+    :type hosts: int
+    :param repeat: Number of runs
+    :type repeat: int
+    :return: Result
+    :rtype: dict
+    """
+    client = db.get_client()
+    http, (http_port,) = await fakes.listen(1, http=True)
+    tcp, tcp_ports = await fakes.listen(5)
+    seed(calls.Sql(), [f"http://127.0.0.1:{http_port}/site{i}" for i in range(sites)],
+         [f"127.0.{i // 250}.{i % 250 + 1}" for i in range(hosts)], ",".join(map(str, tcp_ports)))
+
+    async def cycle():
+        for entity in client.query(kind="Monitor").fetch():
+            client.delete(entity.key)
+        await calls.worker()
+
+    try:
+        timings = await timed(cycle, repeat)
+    finally:
+        await fakes.close(http + tcp)
+    return result('worker', {'sites': sites, 'hosts': hosts}, 1, timings)
+
+
+async def main(args):
+    """
+    Run the benchmarks.
+
+    :param args: Command line arguments
+    :type args: argparse.Namespace
+    :return: Report
+    :rtype: dict
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    utils.logger.setLevel(logging.WARNING)
+    utils.outbox.bot = fakes.FakeBot()
+    calls = load_calls()
+    plan = QUICK if args.quick else {'menu': tuple(MENU_SIZES), 'ports': PORTS, 'targets': TARGETS}
+    results = []
+    for size in plan['menu']:
+        results.extend(await bench_menu(size, args.repeat))
+    for ports in plan['ports']:
+        results.append(await bench_scan(calls, ports, args.repeat))
+    for sites, hosts in plan['targets']:
+        results.append(await bench_worker(calls, sites, hosts, args.repeat))
+    await utils.outbox.stop()
+    return {
+        'time': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'storage': db.STORAGE_BACKEND,
+        'unit': 'seconds per operation',
+        'results': results,
+    }
+
+
+def parse_args():
+    """
+    Parse command line arguments.
+
+    :return: Arguments
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0].strip())
+    parser.add_argument("--repeat", type=int, default=5, help="runs of every benchmark")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes only, for CI")
+    parser.add_argument("--output", help="write the JSON report to a file instead of stdout")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    try:
+        report = asyncio.run(main(arguments))
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, encoding="utf-8", mode="w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,159 @@
+# MIT License
+#
+# Copyright (c) 2024 carpaty https://github.com/carpaty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# -*- coding: utf-8 -*-
+
+"""
+Callback query routing
+"""
+
+import os
+import secrets
+from datetime import datetime, timedelta, timezone
+
+import utils
+
+PREFIX = "cb"
+LEGACY_PREFIX = "inftrx"
+PACKED_LENGTH = len(PREFIX) + 17
+CALLBACK_TTL = float(os.environ.get('CALLBACK_TTL', 7 * 86400))
+
+actions = {}
+routes = {}
+
+
+def action(func):
+    """
+    Register a function as a callback action, under its own name.
+
+    Actions are called with the user ID followed by the packed arguments.
+
+    :param func: Action function
+    :type func: callable
+    :return: The function
+    :rtype: callable
+    """
+    actions[func.__name__] = func
+    return func
+
+
+def route(handler, *keys):
+    """
+    Route callback queries to a handler.
+
+    :param handler: Callback query handler
+    :type handler: callable
+    :param keys: Exact callback data, or prefixes of packed callback data
+    :type keys: str
+    """
+    for key in keys:
+        routes[key] = handler
+
+
+async def pack(name, *args):
+    """
+    Build compact callback data for an action.
+
+    The action and its arguments are stored once in the position cache under a
+    random ID, so the callback data has the same short length for any
+    arguments. The stored payload carries an `expire_at` time, `CALLBACK_TTL`
+    from now, for a Datastore TTL policy to remove unused payloads.
+
+    :param name: Action name
+    :type name: str
+    :param args: Arguments of the action
+    :type args: str
+    :return: Callback data
+    :rtype: str
+    """
+    data = f"{PREFIX}_{secrets.token_urlsafe(12)}"
+    expire_at = datetime.now(timezone.utc) + timedelta(seconds=CALLBACK_TTL)
+    await utils.cache.qinsert(data, {'action': name, 'args': list(args)}, expire_at=expire_at)
+    return data
+
+
+def choice(data, value):
+    """
+    Build callback data of one answer to packed data, e.g. the Yes and No buttons
+    of one prompt share a single stored payload.
+
+    :param data: Callback data returned by `pack`
+    :type data: str
+    :param value: Answer passed to the action before the packed arguments
+    :type value: str
+    :return: Callback data
+    :rtype: str
+    """
+    return f"{data}_{value}"
+
+
+async def unpack(data):
+    """
+    Get the action and arguments of callback data.
+
+    Callback data of buttons sent before packing, such as
+    ``inftrx_siteadd_yes_https://example.com``, is parsed directly.
+
+    :param data: Callback data
+    :type data: str
+    :return: Action name and arguments, None if the data is unknown or expired
+    :rtype: tuple[str, list] | None
+    """
+    if data.startswith(f"{LEGACY_PREFIX}_"):
+        _, name, *args = data.split("_", 3)
+        return name, args
+    payload = await utils.cache.qselect(data[:PACKED_LENGTH])
+    if not payload:
+        return None
+    answer = data[PACKED_LENGTH + 1:]
+    return payload['action'], ([answer] if answer else []) + payload['args']
+
+
+async def discard(data):
+    """
+    Delete the payload of used callback data, the other answers of the prompt expire with it.
+
+    :param data: Callback data
+    :type data: str
+    """
+    if data.startswith(f"{PREFIX}_"):
+        await utils.cache.qdelete(data[:PACKED_LENGTH])
+
+
+async def dispatch(update, context):
+    """
+    Pass a callback query to its handler with one table lookup.
+
+    Exact callback data is looked up first, then the prefix before the first ``_``.
+
+    :param update: Incoming update.
+    :type update: telegram.Update
+    :param context: Context for handling the update.
+    :type context: telegram.ext.ContextTypes.DEFAULT_TYPE
+    """
+    data = update.callback_query.data or ""
+    handler = routes.get(data) or routes.get(data.split("_", 1)[0])
+    if handler is None:
+        utils.logger.warning("No route for callback data: %s", data)
+        await update.callback_query.answer()
+        return
+    await handler(update, context)
@@ -26,13 +26,16 @@
 Command handlers for the Telegram bot.
 """
 
+import inspect
 from telegram import Update
 from telegram.ext import ContextTypes
 import menu
+import tracing
 import utils
 from calls import button_func
 
 
+@tracing.traced()
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:  # pylint: disable=unused-argument
     """
     Handle the /start command.
@@ -45,15 +48,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:  #
     if update.message and update.message.from_user:
         user_id = update.message.from_user.id
         utils.logger.info("User /start: %s", user_id)
-        check_exist = utils.user_check(user_id)
+        check_exist = await utils.user_check(user_id)
 
         if check_exist:
             await update.message.reply_text(text='Welcome back')
         else:
-            utils.user_insert(user_id)
+            await utils.user_insert(user_id)
             await update.message.reply_text(text='Welcome', disable_web_page_preview=True)
 
 
+@tracing.traced()
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:  # pylint: disable=unused-argument
     """
     Handle the /help command.
@@ -66,10 +70,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if update.message and update.message.from_user:
         user_id = update.message.from_user.id
         utils.logger.info("User /help: %s", user_id)
-        kbd = menu.gen_menu(user_id)
+        kbd = await menu.gen_menu(user_id)
         await update.message.reply_text(text="Select option", reply_markup=kbd, disable_web_page_preview=True)
 
 
+@tracing.traced()
 async def keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:  # pylint: disable=unused-argument
     """
     Handle keyboard interactions.
@@ -83,10 +88,11 @@ async def keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user_id = update.message.from_user.id
         key_pressed = update.message.text
         utils.logger.info("User: %s pressed key: %s", user_id, key_pressed)
-        res = menu.gen_menu(user_id, key_pressed)
+        res = await menu.gen_menu(user_id, key_pressed)
         await update.message.reply_text(text="Select option", reply_markup=res, disable_web_page_preview=True)
 
 
+@tracing.traced()
 async def echocall(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:  # pylint: disable=unused-argument
     """
     Handle echo calls triggered when a user presses a button.
@@ -100,9 +106,13 @@ async def echocall(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user_id = update.message.from_user.id
         message_text = update.message.text
         utils.logger.info("User: %s typed: %s", user_id, message_text)
-        method_name = utils.check_button(user_id)
+        method_name = await utils.check_button(user_id)
         method_to_call = getattr(button_func, method_name['current'])
-        text, ver = method_to_call(message_text)
+        with tracing.span(f"calls.{method_name['current']}"):
+            res = method_to_call(message_text)
+            if inspect.isawaitable(res):
+                res = await res
+        text, ver = res
         await update.message.reply_text(text=text, reply_markup=ver, disable_web_page_preview=True)
 
 
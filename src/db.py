@@ -26,22 +26,184 @@
 DB Module
 """
 
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from google.cloud import datastore
 from google.cloud.datastore.query import PropertyFilter
 
+import localdb
+import lru
+import metrics
+import tracing
 
-class Sql:
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'datastore')
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'itb.sqlite3')
+POSITION_CACHE_SIZE = int(os.environ.get('POSITION_CACHE_SIZE', 10000))
+POSITION_CACHE_TTL = float(os.environ.get('POSITION_CACHE_TTL', 300))
+DB_WORKERS = int(os.environ.get('DB_WORKERS', 8))
+
+_clients = {}
+_clients_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+
+def get_client():
+    """
+    Get the storage client shared by the process.
+
+    The client is created on first use and reused by every DB object, one
+    client per backend.
+    `STORAGE_BACKEND` selects Google Datastore (``datastore``) or a local
+    SQLite file at `SQLITE_PATH` (``sqlite``), which offers the same subset
+    of the client API.
+
+    :return: Storage client
+    :rtype: google.cloud.datastore.Client | localdb.Client
+    :raises: `ValueError` if the backend is unknown
+    """
+    client = _clients.get(STORAGE_BACKEND)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(STORAGE_BACKEND)
+            if client is None:
+                client = _clients[STORAGE_BACKEND] = create_client(STORAGE_BACKEND)
+    return client
+
+
+def create_client(backend):
+    """
+    Create a storage client.
+
+    :param backend: ``datastore`` or ``sqlite``
+    :type backend: str
+    :return: Storage client
+    :rtype: google.cloud.datastore.Client | localdb.Client
+    :raises: `ValueError` if the backend is unknown
+    """
+    if backend == 'datastore':
+        return datastore.Client()
+    if backend == 'sqlite':
+        return localdb.Client(SQLITE_PATH)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+async def run(func, *args, **kwargs):
+    """
+    Run a blocking DB call in the bounded DB executor.
+
+    :param func: Blocking callable
+    :type func: callable
+    :return: Result of the call
+    :rtype: any
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+async def stream(select_page, *args, page_size=500):
+    """
+    Iterate over a paged query, fetching one page at a time in the DB executor.
+
+    :param select_page: Blocking callable returning a page and the next cursor,
+        called with `cursor` and `limit` keyword arguments
+    :type select_page: callable
+    :param page_size: Entities per page, defaults to 500
+    :type page_size: int, optional
+    :yield: Entity
+    :rtype: AsyncIterator[dict]
+    """
+    kind = args[0] if args else ""
+    select_page = metrics.db_call(select_page, kind, select_page.__name__)
+    cursor = None
+    while True:
+        with tracing.span(f"db.{kind}.{select_page.__name__}"):
+            page, cursor = await run(select_page, *args, cursor=cursor, limit=page_size)
+        for entity in page:
+            yield entity
+        if not cursor:
+            return
+
+
+class Async:  # pylint: disable=too-few-public-methods
+    """
+    Async facade for a DB object.
+
+    Every method of the wrapped object becomes a coroutine that runs the
+    blocking call in the DB executor, e.g. ``await Async(Sql()).qselect(uid)``.
+    Call latency is recorded by entity kind: the `kind` of the wrapped object,
+    or the first argument for objects serving several kinds.
+
+    :ivar sync: Wrapped DB object
+    :vartype sync: Sql | Cache
+    """
+
+    def __init__(self, sync):
+        self.sync = sync
+
+    def __getattr__(self, name):
+        method = getattr(self.sync, name)
+
+        async def call(*args, **kwargs):
+            kind = getattr(self.sync, 'kind', args[0] if args else "")
+            with tracing.span(f"db.{kind}.{name}"):
+                return await run(metrics.db_call(method, kind, name), *args, **kwargs)
+        return call
+
+
+class AsyncCache(Async):  # pylint: disable=too-few-public-methods
+    """
+    Async facade for `Cache` serving in-memory hits on the event loop.
+
+    Only misses and writes run in the DB executor, so hits never wait behind
+    blocking Datastore calls and are not recorded as storage latency.
+    """
+
+    async def qselect(self, name):
+        """
+        Get state/button position.
+
+        :param name: Name of the state/button
+        :type name: str
+        :return: State dictionary if exists
+        :rtype: dict
+        """
+        state = self.sync.cached(name)
+        if state is not None:
+            return state
+        return await self.qload(name)
+
+
+class Store:  # pylint: disable=too-few-public-methods
+    """
+    Base of the DB objects, giving them the storage client of the process.
+    """
+
+    @property
+    def client(self):
+        """
+        Shared storage client.
+
+        :return: Storage client
+        :rtype: google.cloud.datastore.Client | localdb.Client
+        """
+        return get_client()
+
+
+class Sql(Store):
     """
     DB for users.
 
-    :ivar client: Datastore client
-    :vartype client: google.cloud.datastore.Client
+    :ivar client: Storage client
+    :vartype client: google.cloud.datastore.Client | localdb.Client
     :ivar kind: Kind of the datastore entity
     :vartype kind: str
     """
 
     def __init__(self):
-        self.client = datastore.Client()
         self.kind = "Users"
 
     def qselect(self, uid: str) -> str:
@@ -73,6 +235,45 @@ class Sql:
         result = query.fetch()
         return result
 
+    def qselect_uid(self, uuid: str):
+        """
+        Select the ID of a user by UUID.
+
+        Runs a keys-only query limited to one result.
+
+        :param uuid: UUID of the user
+        :type uuid: str
+        :return: User ID if exists
+        :rtype: int | None
+        """
+        query = self.client.query(kind=self.kind)
+        query.add_filter(filter=PropertyFilter("uuid", '=', uuid))
+        query.keys_only()
+        result = list(query.fetch(limit=1))
+        if result:
+            return result[0].key.id_or_name
+        return None
+
+    def qselect_uids(self, uuids: list) -> dict:
+        """
+        Select the IDs of several users by UUID.
+
+        Runs one projection query per 30 UUIDs, the limit of the IN filter.
+
+        :param uuids: UUIDs of the users
+        :type uuids: list[str]
+        :return: User ID by UUID for the UUIDs that exist
+        :rtype: dict
+        """
+        uids = {}
+        for i in range(0, len(uuids), 30):
+            query = self.client.query(kind=self.kind)
+            query.add_filter(filter=PropertyFilter("uuid", 'IN', uuids[i:i + 30]))
+            query.projection = ["uuid"]
+            for entity in query.fetch():
+                uids[entity['uuid']] = entity.key.id_or_name
+        return uids
+
     def qinsert(self, uid: str, uuid: str) -> None:
         """
         Insert a new user.
@@ -89,19 +290,24 @@ class Sql:
         self.client.put(task)
 
 
-class Cache:
+class Cache(Store):
     """
     Cache DB for button and state position.
 
-    :ivar client: Datastore client
-    :vartype client: google.cloud.datastore.Client
+    Reads and writes go through a bounded in-memory LRU cache with TTL, so repeated
+    navigation by the same user is served without a Datastore round trip.
+
+    :ivar client: Storage client
+    :vartype client: google.cloud.datastore.Client | localdb.Client
     :ivar kind: Kind of the datastore entity
     :vartype kind: str
+    :ivar local: In-memory cache in front of Datastore
+    :vartype local: lru.TTLCache
     """
 
-    def __init__(self):
-        self.client = datastore.Client()
+    def __init__(self, maxsize=POSITION_CACHE_SIZE, ttl=POSITION_CACHE_TTL):
         self.kind = "Position"
+        self.local = lru.TTLCache(maxsize, ttl)
 
     def qselect(self, name: str) -> dict:
         """
@@ -112,13 +318,40 @@ class Cache:
         :return: State dictionary if exists
         :rtype: dict
         """
-        task_key = self.client.key(self.kind, name)
-        entity = self.client.get(task_key)
-        if entity and 'state' in entity:
-            return dict(entity['state'])
-        return None
+        state = self.cached(name)
+        if state is None:
+            state = self.qload(name)
+        return state
+
+    def cached(self, name: str) -> dict:
+        """
+        Get state/button position from the in-memory cache only.
+
+        :param name: Name of the state/button
+        :type name: str
+        :return: State dictionary if cached
+        :rtype: dict
+        """
+        state = self.local.get(name)
+        return None if state is None else dict(state)
+
+    def qload(self, name: str) -> dict:
+        """
+        Read state/button position from Datastore and cache it.
+
+        :param name: Name of the state/button
+        :type name: str
+        :return: State dictionary if exists
+        :rtype: dict
+        """
+        entity = self.client.get(self.client.key(self.kind, name))
+        if not entity or 'state' not in entity:
+            return None
+        state = dict(entity['state'])
+        self.local.set(name, state)
+        return dict(state)
 
-    def qinsert(self, name: str, val: dict) -> None:
+    def qinsert(self, name: str, val: dict, expire_at: datetime = None) -> None:
         """
         Update state/button position.
 
@@ -126,12 +359,17 @@ class Cache:
         :type name: str
         :param val: Value of the state
         :type val: dict
+        :param expire_at: Time after which a Datastore TTL policy may delete the entity
+        :type expire_at: datetime, optional
         :return: None
         """
         task_key = self.client.key(self.kind, name)
         task = datastore.Entity(key=task_key)
         task["state"] = val
+        if expire_at is not None:
+            task["expire_at"] = expire_at
         self.client.put(task)
+        self.local.set(name, dict(val))
 
     def qdelete(self, name: str) -> None:
         """
@@ -142,3 +380,71 @@ class Cache:
         :return: None
         """
         self.client.delete(self.client.key(self.kind, name))
+        self.local.pop(name)
+
+
+class Monitor(Store):
+    """
+    State DB for monitored targets.
+
+    :ivar kind: Kind of the datastore entity
+    :vartype kind: str
+    """
+
+    def __init__(self):
+        self.kind = "Monitor"
+
+    def qselect_due(self, now: datetime, limit: int) -> dict:
+        """
+        Get the states of the targets due for a check, most overdue first.
+
+        :param now: Start of the cycle
+        :type now: datetime
+        :param limit: Maximum number of states
+        :type limit: int
+        :return: State by target name
+        :rtype: dict
+        """
+        query = self.client.query(kind=self.kind)
+        query.add_filter(filter=PropertyFilter("next_due", '<=', now))
+        query.order = ["next_due"]
+        return {entity.key.name: dict(entity) for entity in query.fetch(limit=limit)}
+
+    def qselect_names(self) -> set:
+        """
+        Get the names of all targets with a saved state.
+
+        :return: Target names
+        :rtype: set[str]
+        """
+        query = self.client.query(kind=self.kind)
+        query.keys_only()
+        return {entity.key.name for entity in query.fetch()}
+
+    def qdelete_many(self, names: list) -> None:
+        """
+        Delete the states of several targets.
+
+        :param names: Names of the targets
+        :type names: list[str]
+        :return: None
+        """
+        keys = [self.client.key(self.kind, name) for name in names]
+        for i in range(0, len(keys), 500):
+            self.client.delete_multi(keys[i:i + 500])
+
+    def qinsert_many(self, states: dict) -> None:
+        """
+        Update the states of several targets.
+
+        :param states: State by target name
+        :type states: dict
+        :return: None
+        """
+        tasks = []
+        for name, state in states.items():
+            task = datastore.Entity(key=self.client.key(self.kind, name), exclude_from_indexes=("detail", "timings"))
+            task.update(state)
+            tasks.append(task)
+        for i in range(0, len(tasks), 500):
+            self.client.put_multi(tasks[i:i + 500])
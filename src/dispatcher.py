@@ -0,0 +1,304 @@
+# MIT License
+#
+# Copyright (c) 2024 carpaty https://github.com/carpaty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# -*- coding: utf-8 -*-
+
+"""
+Outbound message dispatcher
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import timedelta
+
+import telegram
+
+import metrics
+
+GLOBAL_RATE = float(os.environ.get('TG_GLOBAL_RATE', 30))
+CHAT_RATE = float(os.environ.get('TG_CHAT_RATE', 1))
+WORKERS = int(os.environ.get('TG_DISPATCH_WORKERS', 16))
+QUEUE_SIZE = int(os.environ.get('TG_QUEUE_SIZE', 10000))
+RETRIES = int(os.environ.get('TG_SEND_RETRIES', 3))
+CHATS_KEPT = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    :ivar rate: Tokens added per second
+    :vartype rate: float
+    :ivar burst: Maximum number of tokens
+    :vartype burst: float
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def delay(self):
+        """
+        Take a token if one is available.
+
+        :return: Seconds to wait before a token is available, 0 if one was taken
+        :rtype: float
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        """
+        Wait until a token is available and take it.
+        """
+        while wait := self.delay():
+            await asyncio.sleep(wait)
+
+
+class Dispatcher:  # pylint: disable=too-many-instance-attributes
+    """
+    Shared sender of outbound Telegram messages.
+
+    Messages are queued per chat and sent by a pool of workers through one
+    long-lived bot. A chat is handed to the workers only when its next message
+    is allowed by the per-chat rate, so a burst to one chat never keeps the
+    workers from other chats. Messages to the same chat are sent in order, a
+    global token bucket keeps the bot under Telegram's flood limit, and
+    `RetryAfter` pauses all workers for the requested time before a retry.
+
+    :ivar token: Telegram bot token
+    :vartype token: str
+    :ivar bot: Bot used for sending, created on start
+    :vartype bot: telegram.Bot
+    :ivar ready: Chats whose next message can be sent now
+    :vartype ready: asyncio.Queue
+    :ivar limit: Global rate limiter
+    :vartype limit: TokenBucket
+    :ivar chats: Queued messages, next allowed send time and busy flag by chat
+    :vartype chats: dict
+    :ivar counters: Send counters and latency totals
+    :vartype counters: dict
+    """
+
+    def __init__(self, token, bot=None):
+        self.token = token
+        self.bot = bot
+        self.ready = None
+        self.limit = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.chats = {}
+        self.counters = {'sent': 0, 'failed': 0, 'retry_after': 0, 'paused_until': 0.0,
+                         'send_seconds': 0.0, 'send_max': 0.0, 'wait_seconds': 0.0, 'queued': 0}
+        self._started = None
+        self._slots = None
+        self._idle = None
+        self._workers = []
+
+    async def start(self):
+        """
+        Create the bot and start the workers once, concurrent callers wait for the same start.
+        """
+        if self._started is None:
+            self._started = asyncio.ensure_future(self._start())
+        try:
+            await asyncio.shield(self._started)
+        except Exception:
+            self._started = None
+            raise
+
+    async def _start(self):
+        self.ready = asyncio.Queue()
+        self._slots = asyncio.Semaphore(QUEUE_SIZE)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        if self.bot is None:
+            self.bot = telegram.Bot(token=self.token)
+        await self.bot.initialize()
+        self._workers = [asyncio.create_task(self._work()) for _ in range(WORKERS)]
+
+    async def stop(self):
+        """
+        Send the queued messages and stop the workers.
+        """
+        if self._started is None:
+            return
+        await self.start()
+        await self._idle.wait()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._started = None
+        await self.bot.shutdown()
+
+    async def submit(self, chat_id, text):
+        """
+        Queue a message, waiting while the queue is full.
+
+        Failures are logged by the dispatcher, so the future can be dropped.
+
+        :param chat_id: Chat ID
+        :type chat_id: int | str
+        :param text: Text message
+        :type text: str
+        :return: Future resolved with the sent message or the send error
+        :rtype: asyncio.Future
+        """
+        await self.start()
+        await self._slots.acquire()
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        chat = self.chats.setdefault(chat_id, {'messages': deque(), 'next': 0.0, 'busy': False})
+        chat['messages'].append((text, future, time.monotonic()))
+        self.counters['queued'] += 1
+        self._idle.clear()
+        self._schedule(chat_id)
+        return future
+
+    async def send(self, chat_id, text):
+        """
+        Send a message through the queue and wait for the delivery.
+
+        :param chat_id: Chat ID
+        :type chat_id: int | str
+        :param text: Text message
+        :type text: str
+        :return: Sent message
+        :rtype: telegram.Message
+        """
+        return await (await self.submit(chat_id, text))
+
+    def stats(self):
+        """
+        Get queue depth and send latency.
+
+        :return: Dispatcher counters
+        :rtype: dict
+        """
+        done = self.counters['sent'] + self.counters['failed']
+        return {
+            'queue': self.counters['queued'],
+            'sent': self.counters['sent'],
+            'failed': self.counters['failed'],
+            'retry_after': self.counters['retry_after'],
+            'send_avg': self.counters['send_seconds'] / done if done else 0.0,
+            'send_max': self.counters['send_max'],
+            'wait_avg': self.counters['wait_seconds'] / done if done else 0.0,
+        }
+
+    async def _work(self):
+        while True:
+            chat_id = await self.ready.get()
+            chat = self.chats[chat_id]
+            text, future, enqueued = chat['messages'].popleft()
+            try:
+                self.counters['wait_seconds'] += time.monotonic() - enqueued
+                await self._deliver(chat_id, text, future)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.exception("Dispatcher worker error")
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                chat['next'] = time.monotonic() + 1 / CHAT_RATE
+                chat['busy'] = False
+                self._slots.release()
+                self.counters['queued'] -= 1
+                if not self.counters['queued']:
+                    self._idle.set()
+                self._schedule(chat_id)
+                self._prune()
+
+    def _schedule(self, chat_id):
+        chat = self.chats[chat_id]
+        if chat['busy'] or not chat['messages']:
+            return
+        chat['busy'] = True
+        delay = chat['next'] - time.monotonic()
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.ready.put_nowait, chat_id)
+        else:
+            self.ready.put_nowait(chat_id)
+
+    def _prune(self):
+        if len(self.chats) < CHATS_KEPT:
+            return
+        now = time.monotonic()
+        idle = [chat_id for chat_id, chat in self.chats.items()
+                if not chat['busy'] and not chat['messages'] and chat['next'] <= now]
+        for chat_id in idle:
+            del self.chats[chat_id]
+
+    async def _deliver(self, chat_id, text, future):
+        started = time.monotonic()
+        error = None
+        for attempt in range(RETRIES + 1):
+            await asyncio.sleep(self.counters['paused_until'] - time.monotonic())
+            await self.limit.acquire()
+            started = time.monotonic()
+            try:
+                with metrics.SEND_SECONDS.time():
+                    message = await self.bot.send_message(chat_id=chat_id, text=text)
+            except telegram.error.RetryAfter as e:
+                self.counters['retry_after'] += 1
+                metrics.RETRY_AFTER.inc()
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                self.counters['paused_until'] = time.monotonic() + delay
+                logger.warning("Flood limit, pausing sends for %s s", delay)
+                error = e
+            except (telegram.error.BadRequest, telegram.error.Forbidden) as e:
+                error = e
+                break
+            except telegram.error.TelegramError as e:
+                error = e
+                await asyncio.sleep(attempt + 1)
+            else:
+                logger.info("Message '%s' sent to %s", text, chat_id)
+                self._done(future, started, message=message)
+                return
+        self._done(future, started, error=error)
+
+    def _done(self, future, started, message=None, error=None):
+        elapsed = time.monotonic() - started
+        self.counters['send_seconds'] += elapsed
+        self.counters['send_max'] = max(self.counters['send_max'], elapsed)
+        if error:
+            self.counters['failed'] += 1
+            logger.error("Message send failed: %s", error)
+            if not future.done():
+                future.set_exception(error)
+        else:
+            self.counters['sent'] += 1
+            if not future.done():
+                future.set_result(message)
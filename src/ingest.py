@@ -0,0 +1,310 @@
+# MIT License
+#
+# Copyright (c) 2024 carpaty https://github.com/carpaty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# -*- coding: utf-8 -*-
+
+"""
+Webhook ingestion
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import tracing
+
+try:
+    import orjson
+    loads = orjson.loads  # pylint: disable=no-member
+except ImportError:
+    loads = json.loads
+
+QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 1000))
+SEEN_SIZE = int(os.environ.get('WEBHOOK_SEEN_SIZE', 10000))
+
+logger = logging.getLogger(__name__)
+
+
+class Ingest:
+    """
+    Fast path from the webhook to the application update queue.
+
+    The webhook only decodes the JSON body, drops update IDs seen recently and
+    puts the raw update into a bounded queue. A background task builds the
+    `Update` objects and hands them to the application, waiting while the
+    application's own queue is full.
+
+    :ivar queue: Raw updates waiting for the application
+    :vartype queue: asyncio.Queue
+    :ivar seen: Recently accepted update IDs
+    :vartype seen: collections.OrderedDict
+    :ivar counters: Ingestion counters and latency totals
+    :vartype counters: dict
+    """
+
+    def __init__(self, maxsize=QUEUE_SIZE):
+        self.queue = asyncio.Queue(maxsize)
+        self.seen = OrderedDict()
+        self.counters = {'accepted': 0, 'duplicates': 0, 'rejected': 0,
+                         'handed': 0, 'enqueue_seconds': 0.0, 'enqueue_max': 0.0}
+        self._pump = None
+
+    def put(self, body):
+        """
+        Accept a webhook body.
+
+        :param body: Raw JSON body of the webhook request
+        :type body: bytes
+        :return: False if the queue is full and the update must be redelivered
+        :rtype: bool
+        :raises: `ValueError` if the body is not a JSON object
+        """
+        data = loads(body)
+        if not isinstance(data, dict):
+            raise ValueError("Update is not a JSON object")
+        update_id = data.get('update_id')
+        if update_id is not None and not isinstance(update_id, int):
+            raise ValueError("update_id is not an integer")
+        if update_id in self.seen:
+            self.counters['duplicates'] += 1
+            return True
+        try:
+            self.queue.put_nowait((data, time.monotonic()))
+        except asyncio.QueueFull:
+            self.counters['rejected'] += 1
+            return False
+        self.counters['accepted'] += 1
+        if update_id is not None:
+            self.seen[update_id] = None
+            if len(self.seen) > SEEN_SIZE:
+                self.seen.popitem(last=False)
+        return True
+
+    async def start(self, application):
+        """
+        Start handing updates to the application.
+
+        The background task is restarted if it ever exits other than by `stop`.
+
+        :param application: Application processing the updates
+        :type application: telegram.ext.Application
+        """
+        if self._pump is None:
+            self._pump = asyncio.create_task(self._run(application))
+            self._pump.add_done_callback(functools.partial(self._restart, application))
+
+    async def stop(self):
+        """
+        Stop handing updates to the application.
+        """
+        if self._pump is not None:
+            self._pump.cancel()
+            await asyncio.gather(self._pump, return_exceptions=True)
+            self._pump = None
+
+    def stats(self):
+        """
+        Get queue depth and enqueue latency.
+
+        :return: Ingestion counters
+        :rtype: dict
+        """
+        handed = self.counters['handed']
+        return {
+            'queue': self.queue.qsize(),
+            'accepted': self.counters['accepted'],
+            'duplicates': self.counters['duplicates'],
+            'rejected': self.counters['rejected'],
+            'enqueue_avg': self.counters['enqueue_seconds'] / handed if handed > 0 else 0.0,
+            'enqueue_max': self.counters['enqueue_max'],
+        }
+
+    def _restart(self, application, task):
+        if task.cancelled() or task is not self._pump:
+            return
+        logger.critical("Update pump stopped, restarting", exc_info=task.exception())
+        self._pump = asyncio.create_task(self._run(application))
+        self._pump.add_done_callback(functools.partial(self._restart, application))
+
+    async def _run(self, application):
+        while True:
+            data, received = await self.queue.get()
+            try:
+                await application.update_queue.put(Update.de_json(data=data, bot=application.bot))
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Malformed update dropped: %s", data)
+            elapsed = time.monotonic() - received
+            self.counters['handed'] += 1
+            self.counters['enqueue_seconds'] += elapsed
+            self.counters['enqueue_max'] = max(self.counters['enqueue_max'], elapsed)
+
+
+class UpdateQueue(asyncio.Queue):
+    """
+    Update queue bounded by the updates not processed yet.
+
+    The application creates a task for every update it takes from the queue
+    when updates run concurrently, so a plain bounded queue would stop
+    limiting anything. Here `put` waits until the number of updates queued
+    or being processed is below the limit.
+
+    :ivar limit: Maximum number of updates queued or being processed
+    :vartype limit: int
+    :ivar pending: Updates queued or being processed
+    :vartype pending: int
+    """
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.pending = 0
+        self._room = asyncio.Semaphore(limit)
+
+    async def put(self, item):
+        await self._room.acquire()
+        self.pending += 1
+        await super().put(item)
+
+    def task_done(self):
+        if self.pending > 0:
+            self.pending -= 1
+            self._room.release()
+        super().task_done()
+
+
+class ChatProcessor(BaseUpdateProcessor):
+    """
+    Update processor running updates concurrently but in order per user.
+
+    Updates of the same user (or chat, if there is no user) wait for each
+    other, so the navigation state of a user is never updated by two
+    handlers at once. Inline queries do not touch the navigation state and
+    are ordered separately, so typing inline never waits for a slow command.
+
+    The base processor is given no practical limit, `UPDATES_CONCURRENCY` is
+    applied by a semaphore taken after the lock of the key, so the waiting
+    updates of one busy user never hold the slots other users need.
+
+    :ivar chats: Lock, number of waiting updates and newest update ID by key
+    :vartype chats: dict
+    :ivar running: Number of updates being processed
+    :vartype running: int
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(sys.maxsize)
+        self.chats = {}
+        self.running = 0
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+
+    async def do_process_update(self, update, coroutine):
+        """
+        Run an update once the updates before it with the same key are done.
+
+        :param update: Update to process
+        :type update: object
+        :param coroutine: Coroutine processing the update
+        :type coroutine: Awaitable
+        """
+        key = self.chat_key(update)
+        if key is None:
+            await self.run(type(update).__name__, coroutine)
+            return
+        entry = self.chats.setdefault(key, {'lock': asyncio.Lock(), 'pending': 0, 'newest': 0})
+        entry['pending'] += 1
+        entry['newest'] = max(entry['newest'], update.update_id)
+        try:
+            async with entry['lock']:
+                await self.run(f"update {update.update_id} from {key}", coroutine)
+        finally:
+            entry['pending'] -= 1
+            if not entry['pending']:
+                del self.chats[key]
+
+    async def run(self, name, coroutine):
+        """
+        Run an update in a concurrency slot.
+
+        :param name: Name of the trace span
+        :type name: str
+        :param coroutine: Coroutine processing the update
+        :type coroutine: Awaitable
+        """
+        async with self._slots:
+            self.running += 1
+            try:
+                await tracing.run(name, coroutine)
+            finally:
+                self.running -= 1
+
+    async def initialize(self):
+        """
+        Nothing to prepare.
+        """
+
+    async def shutdown(self):
+        """
+        Nothing to release.
+        """
+
+    def superseded(self, update):
+        """
+        Check whether a newer update with the same key is already waiting.
+
+        Used to drop inline queries the user has already typed over.
+
+        :param update: Update being processed
+        :type update: telegram.Update
+        :return: True if a newer update has arrived
+        :rtype: bool
+        """
+        entry = self.chats.get(self.chat_key(update))
+        return entry is not None and entry['newest'] > update.update_id
+
+    @staticmethod
+    def chat_key(update):
+        """
+        Get the key updates are ordered by.
+
+        :param update: Incoming update
+        :type update: object
+        :return: User ID, chat ID, ("inline", user ID) for inline queries
+            or None for updates without user and chat
+        :rtype: int | tuple
+        """
+        if not isinstance(update, Update):
+            return None
+        if update.inline_query:
+            return "inline", update.inline_query.from_user.id
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
@@ -26,58 +26,135 @@
 Module for handling inline queries in a Telegram bot.
 """
 
-from uuid import uuid4
+import hashlib
+import os
 
 from telegram import (
     InlineQueryResultArticle,
     InputTextMessageContent,
     Update)
-from telegram.constants import ParseMode
+from telegram.constants import InlineQueryLimit, ParseMode
 from telegram.helpers import escape_markdown
 from telegram.ext import ContextTypes
 
+import lru
 from utils import logger
 
+INLINE_CACHE_SIZE = int(os.environ.get('INLINE_CACHE_SIZE', 1024))
+INLINE_CACHE_TTL = float(os.environ.get('INLINE_CACHE_TTL', 300))
+INLINE_CACHE_TIME = int(os.environ.get('INLINE_CACHE_TIME', 300))
+INLINE_PAGE_SIZE = min(int(os.environ.get('INLINE_PAGE_SIZE', InlineQueryLimit.RESULTS)), InlineQueryLimit.RESULTS)
 
-async def inlinequery(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:  # pylint: disable=unused-argument
+rendered = lru.TTLCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+
+
+def result_id(kind, query):
     """
-    Handle the inline query.
+    Build a result ID that is the same for the same result of the same query.
 
-    :param update: The update object.
-    :type update: telegram.Update
-    :param context: The context object.
-    :type context: telegram.ext.ContextTypes.DEFAULT_TYPE
+    :param kind: Result kind
+    :type kind: str
+    :param query: Query text
+    :type query: str
+    :return: Result ID, at most 64 bytes
+    :rtype: str
     """
-    if update.inline_query is not None:
-        query = update.inline_query.query
-        logger.info("Inline query received: %s", query)
-    else:
-        logger.info("Missing query")
-        query = ""
+    return f"{kind}:{hashlib.sha1(query.encode()).hexdigest()}"
 
-    results = [
+
+def formats(query):
+    """
+    Provide the query text in capitals, bold and italic.
+
+    :param query: Query text
+    :type query: str
+    :return: Inline query results
+    :rtype: list[telegram.InlineQueryResultArticle]
+    """
+    escaped = escape_markdown(query)
+    return [
         InlineQueryResultArticle(
-            id=str(uuid4()),
+            id=result_id("caps", query),
             title="Caps",
             input_message_content=InputTextMessageContent(query.upper())
         ),
         InlineQueryResultArticle(
-            id=str(uuid4()),
+            id=result_id("bold", query),
             title="Bold",
             input_message_content=InputTextMessageContent(
-                f"*{escape_markdown(query)}*",
+                f"*{escaped}*",
                 parse_mode=ParseMode.MARKDOWN
             )
         ),
         InlineQueryResultArticle(
-            id=str(uuid4()),
+            id=result_id("italic", query),
             title="Italic",
             input_message_content=InputTextMessageContent(
-                f"_{escape_markdown(query)}_",
+                f"_{escaped}_",
                 parse_mode=ParseMode.MARKDOWN
             )
         )
     ]
 
-    if update.inline_query is not None:
-        await update.inline_query.answer(results)
+
+providers = [formats]
+
+
+def results(query):
+    """
+    Get the results of all providers for a query, rendered once per query text.
+
+    :param query: Query text
+    :type query: str
+    :return: Inline query results
+    :rtype: list[telegram.InlineQueryResult]
+    """
+    cached = rendered.get(query)
+    if cached is None:
+        cached = [result for provider in providers for result in provider(query)]
+        rendered.set(query, cached)
+    return cached
+
+
+def page(items, offset):
+    """
+    Cut one page of results.
+
+    :param items: All results
+    :type items: list
+    :param offset: Offset sent by Telegram, empty for the first page
+    :type offset: str
+    :return: Results of the page and the offset of the next page, empty after the last page
+    :rtype: tuple[list, str]
+    """
+    start = int(offset) if offset.isdigit() else 0
+    end = start + INLINE_PAGE_SIZE
+    return items[start:end], str(end) if end < len(items) else ""
+
+
+async def inlinequery(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle the inline query.
+
+    Results come from the rendered results cache and are answered one page at a time
+    with Telegram-side caching. A query is dropped when the same user has already sent
+    a newer one.
+
+    :param update: The update object.
+    :type update: telegram.Update
+    :param context: The context object.
+    :type context: telegram.ext.ContextTypes.DEFAULT_TYPE
+    """
+    if update.inline_query is None:
+        logger.info("Missing query")
+        return
+    query = update.inline_query.query
+    logger.info("Inline query received: %s", query)
+
+    superseded = getattr(context.application.update_processor, 'superseded', None)
+    if superseded and superseded(update):
+        logger.info("Inline query dropped, a newer one is waiting: %s", query)
+        return
+
+    items, next_offset = page(results(query), update.inline_query.offset)
+    await update.inline_query.answer(items, cache_time=INLINE_CACHE_TIME, is_personal=False, next_offset=next_offset)
@@ -0,0 +1,348 @@
+# MIT License
+#
+# Copyright (c) 2024 carpaty https://github.com/carpaty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# -*- coding: utf-8 -*-
+
+"""
+SQLite storage backend
+"""
+
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from google.cloud import datastore
+
+PROJECT = "local"
+INDEXED = ("uid", "uuid", "Sites", "Hosts")
+OPERATORS = {'=': '=', '!=': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    uid, uuid, Sites, Hosts,
+    props TEXT NOT NULL,
+    PRIMARY KEY (kind, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entities_uid ON entities (kind, uid);
+CREATE INDEX IF NOT EXISTS entities_uuid ON entities (kind, uuid);
+CREATE INDEX IF NOT EXISTS entities_sites ON entities (kind, Sites);
+CREATE INDEX IF NOT EXISTS entities_hosts ON entities (kind, Hosts);
+CREATE INDEX IF NOT EXISTS entities_next_due ON entities (kind, json_extract(props, '$.next_due."$datetime"'));
+"""
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _hook(value):
+    if len(value) == 1 and '$datetime' in value:
+        return datetime.fromisoformat(value['$datetime'])
+    return value
+
+
+def dumps(value):
+    """
+    Serialize entity properties, keeping datetimes.
+
+    :param value: Properties
+    :type value: dict
+    :return: JSON text
+    :rtype: str
+    """
+    return json.dumps(value, default=_default, ensure_ascii=False)
+
+
+def loads(text):
+    """
+    Deserialize entity properties.
+
+    :param text: JSON text
+    :type text: str
+    :return: Properties
+    :rtype: dict
+    """
+    return json.loads(text, object_hook=_hook)
+
+
+class Result:  # pylint: disable=too-few-public-methods
+    """
+    Fetched page of a query, iterable like a Datastore query iterator.
+
+    :ivar pages: Iterator over the single fetched page
+    :vartype pages: Iterator[list]
+    :ivar next_page_token: Cursor of the next page, None after the last page
+    :vartype next_page_token: str
+    """
+
+    def __init__(self, entities, next_page_token):
+        self._entities = entities
+        self.pages = iter([entities])
+        self.next_page_token = next_page_token
+
+    def __iter__(self):
+        return iter(self._entities)
+
+
+class Query:
+    """
+    Query over one kind, supporting the Datastore query features used by the bot:
+    property filters, projections, keys-only queries, sort orders, limits and cursors.
+    Cursors follow the key order, so they are used only without a sort order.
+
+    :ivar kind: Kind of the entities
+    :vartype kind: str
+    :ivar projection: Properties to return, all if empty
+    :vartype projection: list[str]
+    :ivar order: Properties to sort by, descending if prefixed with ``-``
+    :vartype order: list[str]
+    """
+
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+        self.projection = []
+        self.order = []
+        self._filters = []
+        self._keys_only = False
+
+    def add_filter(self, filter):  # pylint: disable=redefined-builtin
+        """
+        Add a property filter.
+
+        :param filter: Filter on one property
+        :type filter: google.cloud.datastore.query.PropertyFilter
+        :return: The query
+        :rtype: Query
+        """
+        self._filters.append((filter.property_name, filter.operator, filter.value))
+        return self
+
+    def keys_only(self):
+        """
+        Return only the keys of the entities.
+        """
+        self._keys_only = True
+
+    def fetch(self, limit=None, start_cursor=None):
+        """
+        Run the query.
+
+        :param limit: Maximum number of entities
+        :type limit: int
+        :param start_cursor: Cursor returned with the previous page
+        :type start_cursor: str
+        :return: Entities and the cursor of the next page
+        :rtype: Result
+        """
+        where, args = self._where(start_cursor)
+        order = []
+        for prop in self.order:
+            name = prop.lstrip('-')
+            order.append(f"COALESCE(json_extract(props, '$.{name}.\"$datetime\"'), {self._column(name)})"
+                         f" {'DESC' if prop.startswith('-') else 'ASC'}")
+        sql = f"SELECT name, props FROM entities WHERE {where} ORDER BY {', '.join(order + ['name'])}"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        rows = self.client.connection().execute(sql, args).fetchall()
+        entities = []
+        for name, props in rows:
+            entity = datastore.Entity(key=self.client.key(self.kind, json.loads(name)))
+            if not self._keys_only:
+                props = loads(props)
+                if self.projection:
+                    if not all(prop in props for prop in self.projection):
+                        continue
+                    props = {prop: props[prop] for prop in self.projection}
+                entity.update(props)
+            entities.append(entity)
+        cursor = rows[-1][0] if limit and len(rows) == limit else None
+        return Result(entities, cursor)
+
+    def _where(self, start_cursor):
+        where = ["kind = ?"]
+        args = [self.kind]
+        for prop, operator, value in self._filters:
+            column = self._column(prop)
+            if isinstance(value, datetime):
+                column = f"json_extract(props, '$.{prop}.\"$datetime\"')"
+                value = value.isoformat()
+            if operator == 'IN':
+                where.append(f"{column} IN ({', '.join('?' * len(value))})")
+                args.extend(value)
+            elif operator == 'NOT_IN':
+                where.append(f"{column} NOT IN ({', '.join('?' * len(value))})")
+                args.extend(value)
+            else:
+                where.append(f"{column} {OPERATORS[operator]} ?")
+                args.append(value)
+        if start_cursor:
+            where.append("name > ?")
+            args.append(start_cursor)
+        return ' AND '.join(where), args
+
+    @staticmethod
+    def _column(prop):
+        return prop if prop in INDEXED else f"json_extract(props, '$.{prop}')"
+
+
+class Client:
+    """
+    SQLite storage with the subset of the Datastore client API used by the bot.
+
+    Keys and entities are the Datastore library types, so callers build and
+    read them the same way for both backends.
+
+    Entities of all kinds are kept in one table in WAL mode. The properties
+    the bot filters on (uid, uuid, Sites, Hosts) are copied to indexed columns,
+    other properties are filtered through `json_extract`. Every thread gets its
+    own connection.
+
+    :ivar path: Path of the database file
+    :vartype path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.connection().executescript(SCHEMA)
+
+    def connection(self):
+        """
+        Get the connection of the current thread.
+
+        :return: SQLite connection
+        :rtype: sqlite3.Connection
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def key(kind, id_or_name):
+        """
+        Build a key.
+
+        :param kind: Kind of the entity
+        :type kind: str
+        :param id_or_name: Integer ID or string name of the entity
+        :type id_or_name: int | str
+        :return: Key
+        :rtype: google.cloud.datastore.Key
+        """
+        return datastore.Key(kind, id_or_name, project=PROJECT)
+
+    def query(self, kind):
+        """
+        Start a query over one kind.
+
+        :param kind: Kind of the entities
+        :type kind: str
+        :return: Query
+        :rtype: Query
+        """
+        return Query(self, kind)
+
+    def get(self, key):
+        """
+        Get an entity by key.
+
+        :param key: Key of the entity
+        :type key: google.cloud.datastore.Key
+        :return: Entity if exists
+        :rtype: google.cloud.datastore.Entity | None
+        """
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def get_multi(self, keys):
+        """
+        Get several entities by key.
+
+        :param keys: Keys of the entities
+        :type keys: list[google.cloud.datastore.Key]
+        :return: Entities that exist
+        :rtype: list[google.cloud.datastore.Entity]
+        """
+        entities = []
+        conn = self.connection()
+        for key in keys:
+            row = conn.execute("SELECT props FROM entities WHERE kind = ? AND name = ?",
+                               (key.kind, json.dumps(key.id_or_name))).fetchone()
+            if row:
+                entity = datastore.Entity(key=key)
+                entity.update(loads(row[0]))
+                entities.append(entity)
+        return entities
+
+    def put(self, entity):
+        """
+        Insert or replace an entity.
+
+        :param entity: Entity with a key
+        :type entity: google.cloud.datastore.Entity
+        """
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        """
+        Insert or replace several entities in one transaction.
+
+        :param entities: Entities with keys
+        :type entities: list[google.cloud.datastore.Entity]
+        """
+        rows = [(entity.key.kind, json.dumps(entity.key.id_or_name),
+                 *(entity.get(prop) for prop in INDEXED), dumps(dict(entity)))
+                for entity in entities]
+        with self.connection() as conn:
+            conn.execute("BEGIN")
+            conn.executemany("INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def delete(self, key):
+        """
+        Delete an entity.
+
+        :param key: Key of the entity, or the entity itself
+        :type key: google.cloud.datastore.Key | google.cloud.datastore.Entity
+        """
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        """
+        Delete several entities in one transaction.
+
+        :param keys: Keys of the entities, or the entities themselves
+        :type keys: list[google.cloud.datastore.Key | google.cloud.datastore.Entity]
+        """
+        rows = [(key.kind, json.dumps(key.id_or_name)) for key in (getattr(key, 'key', key) for key in keys)]
+        with self.connection() as conn:
+            conn.execute("BEGIN")
+            conn.executemany("DELETE FROM entities WHERE kind = ? AND name = ?", rows)
@@ -0,0 +1,199 @@
+# MIT License
+#
+# Copyright (c) 2024 carpaty https://github.com/carpaty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# -*- coding: utf-8 -*-
+
+"""
+In-memory LRU cache with TTL
+"""
+
+import asyncio
+import inspect
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire after a TTL.
+
+    :ivar maxsize: Maximum number of entries
+    :vartype maxsize: int
+    :ivar ttl: Default time to live of an entry in seconds
+    :vartype ttl: float
+    :ivar hits: Number of lookups served from the cache
+    :vartype hits: int
+    :ivar misses: Number of lookups not found or expired
+    :vartype misses: int
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        Get a value and mark it as recently used.
+
+        :param key: Cache key
+        :type key: hashable
+        :param default: Value returned on a miss, defaults to None
+        :type default: any, optional
+        :return: Cached value or default
+        :rtype: any
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value, evicting the least recently used entry when full.
+
+        :param key: Cache key
+        :type key: hashable
+        :param value: Value to store
+        :type value: any
+        :param ttl: Time to live in seconds, defaults to the cache TTL
+        :type ttl: float, optional
+        """
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        """
+        Remove a value.
+
+        :param key: Cache key
+        :type key: hashable
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all values.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        Get cache counters.
+
+        :return: Size, hits and misses of the cache
+        :rtype: dict
+        """
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+class ResultCache(TTLCache):
+    """
+    TTL cache of lookup results where concurrent lookups of the same key share one call.
+
+    :ivar inflight: Running lookups by key
+    :vartype inflight: dict
+    :ivar collapsed: Number of lookups that joined a running one
+    :vartype collapsed: int
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        super().__init__(maxsize, ttl)
+        self.inflight = {}
+        self.collapsed = 0
+
+    async def fetch(self, key, func, *args):
+        """
+        Get a cached result or compute it once for all concurrent callers.
+        Failed lookups are not cached, every waiting caller gets the error.
+
+        :param key: Cache key
+        :type key: hashable
+        :param func: Function or coroutine function computing the result
+        :type func: callable
+        :param args: Arguments of func
+        :type args: any
+        :return: Cached or computed result
+        :rtype: any
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._run(key, func, *args))
+            self.inflight[key] = future
+        else:
+            self.collapsed += 1
+        return await asyncio.shield(future)
+
+    async def _run(self, key, func, *args):
+        try:
+            value = func(*args)
+            if inspect.isawaitable(value):
+                value = await value
+            self.set(key, value, self.lifetime(value))
+            return value
+        finally:
+            self.inflight.pop(key, None)
+
+    def lifetime(self, value):  # pylint: disable=unused-argument
+        """
+        Get the time to live of a computed result.
+
+        :param value: Computed result
+        :type value: any
+        :return: Time to live in seconds
+        :rtype: float
+        """
+        return self.ttl
+
+    def stats(self):
+        """
+        Get cache counters.
+
+        :return: Size, hits, misses, running and collapsed lookups of the cache
+        :rtype: dict
+        """
+        return dict(super().stats(), inflight=len(self.inflight), collapsed=self.collapsed)
+
+
+_MISSING = object()
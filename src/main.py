@@ -26,14 +26,17 @@
 Main Module
 """
 
+import asyncio
+import hmac
 import os
+import time
 from contextlib import asynccontextmanager
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import backoff
 import telegram
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from starlette.responses import Response, PlainTextResponse
-from telegram import Update
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -44,12 +47,22 @@ from telegram.ext import (
 )
 
 import utils
+import callbacks
+import ingest
+import metrics
+import tracing
 import inlinequery
 import commands
 
 from calls.button_func import button, button_int, worker
 
 TELEGRAM_WEBHOOK_URL = os.environ.get('TELEGRAM_WEBHOOK_URL')
+TG_BATCH_SIZE = int(os.environ.get('TG_BATCH_SIZE', 100))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 100))
+UPDATES_CONCURRENCY = int(os.environ.get('UPDATES_CONCURRENCY', 32))
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+ingress = ingest.Ingest()
 
 
 @backoff.on_exception(backoff.expo, telegram.error.RetryAfter, max_time=60)
@@ -58,17 +71,51 @@ async def set_webhook():
     Set the webhook for the Telegram bot.
 
     This function sets the webhook for the Telegram bot using the URL specified
-    in the environment variable `TELEGRAM_WEBHOOK_URL`.
+    in the environment variable `TELEGRAM_WEBHOOK_URL`. The webhook is only
+    registered when Telegram reports a different URL.
 
     :raises: `telegram.error.RetryAfter`
     """
-    if TELEGRAM_WEBHOOK_URL != "None":
-        utils.logger.info(
-            "Setting webhook by URL %s/webhook...", TELEGRAM_WEBHOOK_URL)
-        await app_.bot.set_webhook(url=f"{TELEGRAM_WEBHOOK_URL}/webhook")
-        utils.logger.info("Webhook set!")
-    else:
+    if TELEGRAM_WEBHOOK_URL in (None, "None"):
         utils.logger.info("Webhook URL is None, skipping...")
+        return
+    url = f"{TELEGRAM_WEBHOOK_URL}/webhook"
+    webhook_info = await app_.bot.get_webhook_info()
+    if webhook_info.url == url:
+        utils.logger.info("Webhook already set: %s", url)
+        return
+    utils.logger.info("Setting webhook by URL %s...", url)
+    await app_.bot.set_webhook(url=url)
+    utils.logger.info("Webhook set!")
+
+
+def process_age():
+    """
+    Get the time since the process started, including interpreter start and imports.
+
+    :return: Seconds, None where /proc is not available
+    :rtype: float | None
+    """
+    try:
+        with open("/proc/self/stat", encoding="utf-8") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", encoding="utf-8") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+async def register_webhook():
+    """
+    Set the webhook in the background, logging how long it took.
+    """
+    started = time.perf_counter()
+    try:
+        await set_webhook()
+    except telegram.error.TelegramError as e:
+        utils.logger.error("Webhook is not set: %s", e)
+    utils.logger.info("Startup: webhook checked in %.3f s", time.perf_counter() - started)
 
 
 @asynccontextmanager
@@ -77,36 +124,57 @@ async def lifespan(apps: FastAPI):  # pylint: disable=unused-argument
     Manage the lifespan of the FastAPI application.
 
     This function manages the startup and shutdown sequences of the FastAPI application.
+    The webhook is checked in the background, so updates are served as soon as the
+    application has started. Startup phase timings are logged.
 
     :param apps: The FastAPI application instance.
     :type apps: FastAPI
     """
-    await set_webhook()
+    age = process_age()
+    started = time.perf_counter()
     await app_.initialize()
+    initialized = time.perf_counter()
     await app_.start()
-    webhook_info = await app_.bot.get_webhook_info()
-    utils.logger.info("Webhook info: %s", webhook_info)
+    await ingress.start(app_)
+    webhook = asyncio.create_task(register_webhook())
+    utils.logger.info("Startup: process %s s before lifespan, initialize %.3f s, start %.3f s",
+                      f"{age:.2f}" if age is not None else "?", initialized - started,
+                      time.perf_counter() - initialized)
     yield
+    await asyncio.gather(webhook, return_exceptions=True)
     utils.logger.info("Stopping the application")
+    await ingress.stop()
+    await utils.outbox.stop()
     if isinstance(app_, Application):
         await app_.stop()
         await app_.shutdown()
 
 
-app_ = Application.builder().token(utils.KEY).build()
-app_.add_handler(CommandHandler("start", commands.start))
-app_.add_handler(CommandHandler("help", commands.help_command))
-app_.add_handler(InlineQueryHandler(inlinequery.inlinequery))
+app_ = (
+    Application.builder()
+    .token(utils.KEY)
+    .request(tracing.Request())
+    .update_queue(ingest.UpdateQueue(UPDATE_QUEUE_SIZE))
+    .concurrent_updates(ingest.ChatProcessor(UPDATES_CONCURRENCY))
+    .build()
+)
+app_.add_handler(CommandHandler("start", metrics.handler(commands.start)))
+app_.add_handler(CommandHandler("help", metrics.handler(commands.help_command)))
+app_.add_handler(InlineQueryHandler(metrics.handler(inlinequery.inlinequery)))
 app_.add_handler(MessageHandler(filters.Regex(
-    utils.EMOJI_PATTERN), commands.keyboard))
+    utils.EMOJI_PATTERN), metrics.handler(commands.keyboard)))
 app_.add_handler(MessageHandler(
-    filters.TEXT & ~filters.COMMAND, commands.echocall))
+    filters.TEXT & ~filters.COMMAND, metrics.handler(commands.echocall)))
 app_.add_error_handler(commands.error_handler)
 
 # This is your custom calls located in calls directory
 # file name is button_func.py
-app_.add_handler(CallbackQueryHandler(button, pattern=utils.call_pattern()))
-app_.add_handler(CallbackQueryHandler(button_int, pattern="^inftrx"))
+callbacks.route(metrics.handler(button), *utils.MENU['calls'])
+callbacks.route(metrics.handler(button_int), callbacks.PREFIX, callbacks.LEGACY_PREFIX)
+app_.add_handler(CallbackQueryHandler(callbacks.dispatch))
+
+metrics.UPDATE_QUEUE.set_function(lambda: app_.update_queue.pending)
+metrics.WEBHOOK_QUEUE.set_function(ingress.queue.qsize)
 
 app = FastAPI(lifespan=lifespan)
 
@@ -114,16 +182,22 @@ app = FastAPI(lifespan=lifespan)
 @app.post("/webhook")
 async def telegram_webhook(request: Request) -> Response:
     """
-    Handle incoming Telegram updates by putting them into the `update_queue`.
+    Handle incoming Telegram updates by passing them to the ingestion queue.
+
+    Redelivered updates are acknowledged and dropped. When the queue is full the
+    update is refused with 503, so Telegram delivers it again later.
 
     :param request: The incoming request containing the Telegram update.
     :type request: Request
     :return: An empty response.
     :rtype: Response
     """
-    await app_.update_queue.put(
-        Update.de_json(data=await request.json(), bot=app_.bot)
-    )
+    try:
+        accepted = ingress.put(await request.body())
+    except ValueError:
+        return Response(status_code=400)
+    if not accepted:
+        return Response(status_code=503)
     return Response()
 
 
@@ -143,6 +217,97 @@ async def health(_: Request) -> PlainTextResponse:
     return PlainTextResponse(content="The bot is still running fine :)")
 
 
+@app.get("/metrics")
+async def metrics_endpoint() -> Response:
+    """
+    Metrics in the Prometheus text format.
+
+    :return: Handler, storage, Telegram and monitoring metrics
+    :rtype: Response
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def check_admin(request: Request) -> None:
+    """
+    Check the `X-Admin-Token` header of an admin endpoint against `ADMIN_TOKEN`.
+
+    Admin endpoints are disabled when `ADMIN_TOKEN` is not set.
+
+    :param request: The incoming request.
+    :type request: Request
+    :raises: `HTTPException` 403 if the token does not match
+    """
+    token = request.headers.get('X-Admin-Token', '')
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.get("/stats")
+async def stats(request: Request) -> dict:
+    """
+    Runtime counters endpoint.
+
+    Requires the `X-Admin-Token` header to match `ADMIN_TOKEN`.
+
+    :param request: The incoming request.
+    :type request: Request
+    :return: Webhook and dispatcher queue depth and latency, cache hits and misses.
+    :rtype: dict
+    :raises: `HTTPException` 403 if the token does not match
+    """
+    check_admin(request)
+    import resolver  # pylint: disable=import-outside-toplevel
+    return {
+        'webhook': ingress.stats(),
+        'update_queue': app_.update_queue.pending,
+        'updates_running': app_.update_processor.running,
+        'dispatcher': utils.outbox.stats(),
+        'position_cache': utils.cache.sync.local.stats(),
+        'api_keys': utils.api_keys.stats(),
+        'inline_results': inlinequery.rendered.stats(),
+        'lookups': utils.lookups.stats(),
+        'dns': resolver.get_cache().stats(),
+    }
+
+
+class TraceSettings(BaseModel):
+    """
+    Tracing and profiling settings, omitted fields are kept.
+
+    :param enabled: Log the span breakdown of slow updates
+    :type enabled: bool | None
+    :param slow: Latency above which an update is logged, seconds
+    :type slow: float | None
+    :param profile_rate: Percentage of updates run under the profiler
+    :type profile_rate: float | None
+    """
+    enabled: bool | None = None
+    slow: float | None = Field(default=None, ge=0)
+    profile_rate: float | None = Field(default=None, ge=0, le=100)
+
+
+@app.post("/debug/trace")
+async def trace_settings(request: Request, changes: TraceSettings) -> dict:
+    """
+    Change tracing and profiling at runtime.
+
+    Requires the `X-Admin-Token` header to match `ADMIN_TOKEN`, the endpoint
+    is disabled when `ADMIN_TOKEN` is not set.
+
+    :param request: The incoming request.
+    :type request: Request
+    :param changes: Settings to change
+    :type changes: TraceSettings
+    :return: Current settings
+    :rtype: dict
+    :raises: `HTTPException` 403 if the token does not match
+    """
+    check_admin(request)
+    tracing.settings.update(changes.model_dump(exclude_none=True))
+    return tracing.settings
+
+
 @app.get('/')
 async def root(_: Request) -> PlainTextResponse:
     """
@@ -178,13 +343,75 @@ async def tg_post(items: Items):
     :type items: Items
     :return: A message indicating the result.
     :rtype: dict
+    :raises: `fastapi.HTTPException` 403 if the API key is unknown
     """
     post_hash = items.api_key
     post_text = items.text
-    await utils.post_tg(utils.getuidbyhash(post_hash), post_text)
+    uid = await utils.getuidbyhash(post_hash)
+    if uid is None:
+        raise HTTPException(status_code=403, detail="Invalid api_key")
+    await utils.post_tg(uid, post_text)
     return {'message': "message sent"}
 
 
+class BatchItem(Items):
+    """
+    Data model for one message of a batch request, the text is required.
+
+    :param text: The text message.
+    :type text: str
+    """
+    text: str = Field(min_length=1)
+
+
+class Batch(BaseModel):
+    """
+    Data model for batch POST requests.
+
+    :param messages: Messages to send, possibly for several API keys.
+    :type messages: list[BatchItem]
+    :param wait: Wait for the delivery and report its result.
+    :type wait: bool
+    """
+    messages: list[BatchItem] = Field(max_length=TG_BATCH_SIZE)
+    wait: bool = False
+
+
+@app.post('/tg/batch')
+async def tg_batch(batch: Batch):
+    """
+    Send several messages via the Telegram bot in one request.
+
+    API keys are resolved in bulk and the sends are queued, the response
+    is returned at once unless `wait` is set. Messages without text are
+    rejected with 422 before anything is sent, a failed send is reported
+    in the result of its own message.
+
+    :param batch: The JSON messages and the wait flag.
+    :type batch: Batch
+    :return: Status of every message, in request order.
+    :rtype: dict
+    """
+    uids = await utils.getuidsbyhash(item.api_key for item in batch.messages)
+    results = []
+    sends = []
+    for item in batch.messages:
+        uid = uids[item.api_key]
+        if uid is None:
+            results.append({'status': "rejected", 'error': "Invalid api_key"})
+            continue
+        sends.append((len(results), await utils.outbox.submit(uid, item.text)))
+        results.append({'status': "queued"})
+    if batch.wait:
+        for index, send in sends:
+            try:
+                await send
+                results[index] = {'status': "sent"}
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                results[index] = {'status': "failed", 'error': str(e) or type(e).__name__}
+    return {'results': results}
+
+
 @app.get('/tg')
 async def tg_get():
     """
@@ -207,7 +434,8 @@ async def cron():
     :return: A message indicating the result.
     :rtype: dict
     """
-    await worker()
+    with metrics.WORKER_SECONDS.time():
+        await worker()
     return {'message': "message sent"}
 
 
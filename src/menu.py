@@ -30,21 +30,66 @@ from telegram import (
     InlineKeyboardMarkup,
     InlineKeyboardButton)
 
+import tracing
+import utils
 from utils import (
-    find_key,
-    find,
-    cfg,
     update_state,
     check_state)
 
+EMPTY_MARKUP = InlineKeyboardMarkup([[]])
 
-def gen_menu(uid, item=""):
+_markups = {}
+
+
+def render_markups(index):
+    """
+    Render the keyboard markup of every menu node.
+
+    Nodes with children get a JSON-serialized reply keyboard with the Back button,
+    nodes with buttons get an inline keyboard. The root menu is stored under "".
+
+    :param index: Compiled menu index
+    :type index: dict
+    :return: Rendered markup by node label
+    :rtype: dict
+    """
+    rendered = {"": ReplyKeyboardMarkup([index['root']], resize_keyboard=True).to_json()}
+    for label, node in index['nodes'].items():
+        if node['children']:
+            rendered[label] = ReplyKeyboardMarkup(
+                [node['children'] + ['\U00002B05 Back']], resize_keyboard=True).to_json()
+        else:
+            rendered[label] = InlineKeyboardMarkup([[
+                InlineKeyboardButton(v['name'], callback_data=v['call']) for v in node['inline']]])
+    return rendered
+
+
+def markups():
+    """
+    Get the rendered markups of the loaded menu.
+
+    Markups are rendered once per menu config and re-rendered when `utils.MENU`
+    is replaced by a config with a different digest.
+
+    :return: Rendered markup by node label
+    :rtype: dict
+    """
+    digest = utils.MENU['digest']
+    if _markups.get('digest') != digest:
+        _markups['nodes'] = render_markups(utils.MENU)
+        _markups['digest'] = digest
+    return _markups['nodes']
+
+
+@tracing.traced()
+async def gen_menu(uid, item=""):
     """
     Generate a menu for the user.
 
     This function generates a menu based on the user's current state and the provided item.
     It returns either a ReplyKeyboardMarkup or InlineKeyboardMarkup object, depending on the
-    structure of the menu configuration.
+    structure of the menu configuration. Nodes are looked up in the compiled menu index
+    and their markup is rendered only once.
 
     :param uid: User ID
     :type uid: int
@@ -54,37 +99,14 @@ def gen_menu(uid, item=""):
     :rtype: str
     """
     uid = str(uid)
+    nodes = utils.MENU['nodes']
     if 'Back' in item:
-        cur_stat = check_state(uid)
-        try:
-            a = list(find_key(cfg, cur_stat['current']))
-        except KeyError:
-            a = ''
-        if any(a):
-            return gen_menu(uid, a[0])
-        return gen_menu(uid, "")
-
-    list_item_keyboard = []
-    list_item_inline = []
-    if item:
-        list_find = {}
-        for i in find(item, cfg):
-            list_find = i
-        if isinstance(list_find, dict) and list_find:
-            for key, _ in list_find.items():
-                list_item_keyboard.append(key)
-            list_item_keyboard.append('\U00002B05 Back')
-            update_state(uid, item)
-        elif isinstance(list_find, list):
-            for v in list_find:
-                list_item_inline.append(InlineKeyboardButton(
-                    v['name'], callback_data=v['call']))
-    else:
-        for key, _ in cfg.items():
-            list_item_keyboard.append(key)
-    if list_item_keyboard:
-        ver = ReplyKeyboardMarkup([list_item_keyboard], resize_keyboard=True)
-        return ver.to_json()
-
-    ver = InlineKeyboardMarkup([list_item_inline])
-    return ver
+        cur_stat = await check_state(uid)
+        node = nodes.get(cur_stat.get('current')) if cur_stat else None
+        if node and node['parent']:
+            return await gen_menu(uid, node['parent'])
+        return await gen_menu(uid, "")
+
+    if item in nodes and nodes[item]['children']:
+        await update_state(uid, item)
+    return markups().get(item, EMPTY_MARKUP)
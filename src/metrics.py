@@ -0,0 +1,160 @@
+# MIT License
+#
+# Copyright (c) 2024 carpaty https://github.com/carpaty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# -*- coding: utf-8 -*-
+
+"""
+Prometheus metrics
+"""
+
+import functools
+import time
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily
+
+HANDLER_SECONDS = Histogram(
+    'itb_handler_seconds', "Time spent in a Telegram update handler", ['handler'])
+DB_SECONDS = Histogram(
+    'itb_db_call_seconds', "Time spent in a storage call", ['kind', 'call'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+SEND_SECONDS = Histogram(
+    'itb_telegram_send_seconds', "Time spent in one Telegram sendMessage attempt")
+RETRY_AFTER = Counter(
+    'itb_telegram_retry_after', "Flood limit (RetryAfter) errors from Telegram")
+WORKER_SECONDS = Histogram(
+    'itb_worker_cycle_seconds', "Duration of a monitoring cycle",
+    buckets=(.5, 1, 2.5, 5, 10, 30, 60, 120, 240, 480))
+TARGETS_CHECKED = Counter(
+    'itb_targets_checked', "Monitored targets checked", ['type'])
+PROBE_SECONDS = Histogram(
+    'itb_site_probe_seconds', "Phase duration of a site check request", ['phase'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+DNS_SECONDS = Histogram(
+    'itb_dns_seconds', "Time spent resolving a monitored hostname",
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+DNS_ERRORS = Counter(
+    'itb_dns_errors', "Failed hostname resolutions")
+UPDATE_QUEUE = Gauge(
+    'itb_update_queue_depth', "Updates queued or being processed")
+WEBHOOK_QUEUE = Gauge(
+    'itb_webhook_queue_depth', "Webhook updates waiting to be decoded")
+
+
+def handler(callback):
+    """
+    Record the latency of a Telegram update handler.
+
+    The handler is labelled with the name of the callback.
+
+    :param callback: Handler callback
+    :type callback: callable
+    :return: Wrapped callback
+    :rtype: callable
+    """
+    seconds = HANDLER_SECONDS.labels(callback.__name__)
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        with seconds.time():
+            return await callback(*args, **kwargs)
+    return wrapper
+
+
+def db_call(func, kind, call):
+    """
+    Record the latency of a blocking storage call.
+
+    :param func: Blocking callable
+    :type func: callable
+    :param kind: Entity kind
+    :type kind: str
+    :param call: Name of the call
+    :type call: str
+    :return: Wrapped callable
+    :rtype: callable
+    """
+    seconds = DB_SECONDS.labels(kind, call)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds.observe(time.perf_counter() - started)
+    return wrapper
+
+
+class CacheCollector:
+    """
+    Collector exporting the hit and miss counters of an in-memory cache as a counter.
+
+    The counters are read from the cache on every scrape, so lookups are not counted twice.
+
+    :ivar name: Metric name
+    :vartype name: str
+    :ivar documentation: Metric help text
+    :vartype documentation: str
+    :ivar cache: Cache with `hits` and `misses` counters
+    :vartype cache: lru.TTLCache
+    """
+
+    def __init__(self, name, documentation, cache):
+        self.name = name
+        self.documentation = documentation
+        self.cache = cache
+
+    def describe(self):
+        """
+        Describe the metric without reading the cache.
+
+        :return: Empty metric family
+        :rtype: list[CounterMetricFamily]
+        """
+        return [CounterMetricFamily(self.name, self.documentation, labels=['result'])]
+
+    def collect(self):
+        """
+        Read the cache counters.
+
+        :return: Metric family with the `hit` and `miss` samples
+        :rtype: list[CounterMetricFamily]
+        """
+        family = CounterMetricFamily(self.name, self.documentation, labels=['result'])
+        family.add_metric(['hit'], self.cache.hits)
+        family.add_metric(['miss'], self.cache.misses)
+        return [family]
+
+
+def cache_lookups(name, documentation, cache):
+    """
+    Export the hit and miss counters of a cache.
+
+    :param name: Metric name
+    :type name: str
+    :param documentation: Metric help text
+    :type documentation: str
+    :param cache: Cache with `hits` and `misses` counters
+    :type cache: lru.TTLCache
+    """
+    REGISTRY.register(CacheCollector(name, documentation, cache))
@@ -0,0 +1,638 @@
+# MIT License
+#
+# Copyright (c) 2024 carpaty https://github.com/carpaty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# -*- coding: utf-8 -*-
+
+"""
+Monitoring engine
+"""
+
+import asyncio
+import contextvars
+import os
+import socket
+import ssl
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urljoin
+
+import httpcore
+
+import metrics
+import resolver
+import scanner
+import utils
+
+CONCURRENCY = int(os.environ.get('MONITOR_CONCURRENCY', 50))
+TIMEOUT = float(os.environ.get('MONITOR_TIMEOUT', 20))
+RETRIES = int(os.environ.get('MONITOR_RETRIES', 5))
+RETRY_DELAY = float(os.environ.get('MONITOR_RETRY_DELAY', 1))
+MAX_REDIRECTS = 5
+INTERVAL = int(os.environ.get('MONITOR_INTERVAL', 600))
+BUDGET = float(os.environ.get('MONITOR_BUDGET', 240))
+BATCH = int(os.environ.get('MONITOR_BATCH', 200))
+DUE_LIMIT = int(os.environ.get('MONITOR_DUE_LIMIT', 10000))
+METHOD = os.environ.get('MONITOR_METHOD', 'GET').upper()
+BODY_BYTES = int(os.environ.get('MONITOR_BODY_BYTES', 16384))
+KEEPALIVE = float(os.environ.get('MONITOR_KEEPALIVE', 30))
+
+PORT_MARKS = {"open": "🟩on", "closed": "🟥off"}
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+HTTP_ERRORS = (
+    httpcore.TimeoutException,
+    httpcore.NetworkError,
+    httpcore.ProtocolError,
+    httpcore.UnsupportedProtocol,
+)
+
+Probe = namedtuple('Probe', ['result', 'timings', 'cert_expires'])
+
+_timeline = contextvars.ContextVar('timeline', default=None)
+
+
+class Timeline:
+    """
+    Phase timings of one request, collected from httpcore trace events.
+
+    Phases a reused connection skips (DNS, connect, TLS) are missing from the timings.
+
+    :ivar marks: Start and end time of every traced step
+    :vartype marks: dict[str, float]
+    """
+
+    def __init__(self):
+        self.marks = {}
+
+    async def trace(self, event, info):  # pylint: disable=unused-argument
+        """
+        Record the time of a trace event, passed as the `trace` request extension.
+
+        :param event: Event name, e.g. connection.connect_tcp.started
+        :type event: str
+        :param info: Event arguments
+        :type info: dict
+        """
+        self.marks[event.replace(".failed", ".complete")] = time.perf_counter()
+
+    def between(self, start, end):
+        """
+        Get the time between two traced steps.
+
+        :param start: Event of the first step
+        :type start: str
+        :param end: Event of the last step
+        :type end: str
+        :return: Seconds, None if a step was not traced
+        :rtype: float | None
+        """
+        if start in self.marks and end in self.marks:
+            return round(self.marks[end] - self.marks[start], 4)
+        return None
+
+    def timings(self):
+        """
+        Get the phase timings of the request.
+
+        :return: Seconds by phase: dns, connect, tls, ttfb
+        :rtype: dict[str, float]
+        """
+        connect = "dns.complete" if "dns.complete" in self.marks else "connection.connect_tcp.started"
+        timings = {
+            'dns': self.between("dns.started", "dns.complete"),
+            'connect': self.between(connect, "connection.connect_tcp.complete"),
+            'tls': self.between("connection.start_tls.started", "connection.start_tls.complete"),
+            'ttfb': self.between("http11.send_request_headers.started", "http11.receive_response_headers.complete"),
+        }
+        for phase, seconds in timings.items():
+            if seconds is not None:
+                metrics.PROBE_SECONDS.labels(phase).observe(seconds)
+        return {phase: seconds for phase, seconds in timings.items() if seconds is not None}
+
+
+class Backend(httpcore.AsyncNetworkBackend):
+    """
+    httpcore network backend connecting to the cached addresses of a host.
+
+    TLS still verifies and sends the hostname, only the TCP connection uses the address.
+    The lookup is traced as the ``dns`` step of the timeline of the request.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        timeline = _timeline.get()
+        if timeline is not None:
+            await timeline.trace("dns.started", {})
+        try:
+            addresses = await resolver.resolve(host)
+        except socket.gaierror as err:
+            raise httpcore.ConnectError(str(err)) from err
+        finally:
+            if timeline is not None:
+                await timeline.trace("dns.complete", {})
+        error = None
+        for address in addresses:
+            try:
+                return await self.backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as err:
+                error = err
+        raise error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self.backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds):
+        await self.backend.sleep(seconds)
+
+
+def connection_pool(concurrency=CONCURRENCY):
+    """
+    Create the connection pool of a monitoring cycle.
+
+    Connections are kept alive for `MONITOR_KEEPALIVE` seconds and reused by
+    retries, redirects and other URLs of the same origin.
+
+    :param concurrency: Maximum number of connections, defaults to `MONITOR_CONCURRENCY`
+    :type concurrency: int, optional
+    :return: Connection pool resolving hostnames through the resolver cache
+    :rtype: httpcore.AsyncConnectionPool
+    """
+    return httpcore.AsyncConnectionPool(max_connections=concurrency, keepalive_expiry=KEEPALIVE,
+                                        network_backend=Backend())
+
+
+def cert_expiry(response):
+    """
+    Get the expiry date of the certificate a response was served with.
+
+    :param response: Response of the request
+    :type response: httpcore.Response
+    :return: Expiry date, None for plain HTTP
+    :rtype: datetime | None
+    """
+    stream = response.extensions.get("network_stream")
+    ssl_object = stream.get_extra_info("ssl_object") if stream is not None else None
+    cert = ssl_object.getpeercert() if ssl_object is not None else None
+    if not cert or 'notAfter' not in cert:
+        return None
+    return datetime.fromtimestamp(ssl.cert_time_to_seconds(cert['notAfter']), timezone.utc)
+
+
+async def request(pool, method, url, timeline, timeout):
+    """
+    Send one request and read at most `MONITOR_BODY_BYTES` of the body.
+
+    A body read to the end leaves the connection in the pool for the next request.
+
+    :param pool: Connection pool used for the request
+    :type pool: httpcore.AsyncConnectionPool
+    :param method: HTTP method, GET or HEAD
+    :type method: str
+    :param url: URL of the site
+    :type url: str
+    :param timeline: Collector of the phase timings
+    :type timeline: Timeline
+    :param timeout: Connect/read/write timeout in seconds
+    :type timeout: float
+    :return: HTTP code, Location header and certificate expiry date
+    :rtype: tuple[int, bytes | None, datetime | None]
+    """
+    extensions = {"timeout": {"connect": timeout, "read": timeout, "write": timeout, "pool": timeout},
+                  "trace": timeline.trace}
+    headers = [(b"User-Agent", f"itb/{utils.VERSION}".encode())]
+    async with pool.stream(method, url, headers=headers, extensions=extensions) as response:
+        location = next((v for k, v in response.headers if k.lower() == b"location"), None)
+        expires = cert_expiry(response)
+        read = 0
+        async for chunk in response.aiter_stream():
+            read += len(chunk)
+            if read >= BODY_BYTES:
+                break
+    return response.status, location, expires
+
+
+async def fetch(pool, url, timeout=TIMEOUT, method=METHOD):
+    """
+    Probe a site once, following redirects like `urllib.request.urlopen`.
+
+    HEAD requests answered with 405 or 501 are sent again as GET.
+
+    :param pool: Connection pool used for the request
+    :type pool: httpcore.AsyncConnectionPool
+    :param url: URL of the site
+    :type url: str
+    :param timeout: Connect/read/write timeout in seconds
+    :type timeout: float
+    :param method: HTTP method, defaults to `MONITOR_METHOD`
+    :type method: str, optional
+    :return: Check result (empty string if the site is up, HTTP code or error reason otherwise),
+             phase timings and certificate expiry date of the last request
+    :rtype: Probe
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        timeline = Timeline()
+        token = _timeline.set(timeline)
+        try:
+            status, location, expires = await request(pool, method, url, timeline, timeout)
+            if method == "HEAD" and status in (405, 501):
+                status, location, expires = await request(pool, "GET", url, timeline, timeout)
+        except HTTP_ERRORS as e:
+            return Probe(str(e) or type(e).__name__, timeline.timings(), None)
+        finally:
+            _timeline.reset(token)
+        if status in REDIRECT_CODES and location:
+            url = urljoin(url, location.decode("latin-1"))
+            continue
+        return Probe(status if status >= 400 else '', timeline.timings(), expires)
+    return Probe("Too many redirects", {}, None)
+
+
+async def check_site(pool, limit, url, retries=RETRIES):
+    """
+    Check a site, retrying failed attempts without blocking the event loop.
+
+    Unexpected errors, e.g. an invalid port in the URL, are reported as the
+    result of the site instead of failing the whole cycle.
+
+    :param pool: Connection pool used for the requests
+    :type pool: httpcore.AsyncConnectionPool
+    :param limit: Semaphore bounding the number of checks in flight
+    :type limit: asyncio.Semaphore
+    :param url: URL of the site
+    :type url: str
+    :param retries: Number of attempts, defaults to `MONITOR_RETRIES`
+    :type retries: int, optional
+    :return: Probe of the last attempt, its result is empty if the site is up
+    :rtype: Probe
+    """
+    probe = Probe('', {}, None)
+    async with limit:
+        utils.logger.info("Monitoring: %s", url)
+        for attempt in range(retries):
+            if attempt:
+                await asyncio.sleep(RETRY_DELAY)
+            try:
+                probe = await fetch(pool, url)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                utils.logger.warning("Monitoring: %s failed: %r", url, e)
+                probe = Probe(str(e) or type(e).__name__, {}, None)
+                break
+            if not probe.result:
+                break
+    return probe
+
+
+async def check_sites(urls, concurrency=CONCURRENCY, pool=None):
+    """
+    Check all sites concurrently.
+
+    The cycle takes as long as the slowest site instead of the sum of all sites.
+    Hostnames are resolved through the resolver cache shared with the port scans.
+
+    :param urls: URLs of the sites
+    :type urls: list[str]
+    :param concurrency: Maximum number of checks in flight, defaults to `MONITOR_CONCURRENCY`
+    :type concurrency: int, optional
+    :param pool: Connection pool of the cycle, a new pool is used if omitted
+    :type pool: httpcore.AsyncConnectionPool, optional
+    :return: Probe of every URL, an empty result means the site is up
+    :rtype: dict[str, Probe]
+    """
+    if pool is None:
+        async with connection_pool(concurrency) as own_pool:
+            return await check_sites(urls, concurrency, own_pool)
+    limit = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*(check_site(pool, limit, url) for url in urls))
+    return dict(zip(urls, results))
+
+
+def plan_hosts(hosts):
+    """
+    Merge the port specs of all monitored hosts into one port set per hostname.
+
+    :param hosts: `Hosts` entities of all users
+    :type hosts: list[dict]
+    :return: Ports to scan for every unique hostname
+    :rtype: dict[str, set[int]]
+    """
+    plan = {}
+    for host in hosts:
+        ports = host_ports(host)
+        if isinstance(ports, list):
+            plan.setdefault(host['Hosts'].lower(), set()).update(ports)
+    return plan
+
+
+def host_ports(host):
+    """
+    Parse the port spec of a monitored host.
+
+    :param host: `Hosts` entity
+    :type host: dict
+    :return: Ports of the host, or the error text if the spec is invalid
+    :rtype: list[int] | str
+    """
+    try:
+        return scanner.parse_ports(host['port'])
+    except ValueError as e:
+        return f"Invalid ports {host['port']}: {e}"
+
+
+async def scan_hosts(hosts):
+    """
+    Scan every unique (host, port) pair once and split the results per entity.
+
+    :param hosts: `Hosts` entities of all users
+    :type hosts: list[dict]
+    :return: Every entity paired with the status of its own ports, or with the
+        error text if its port spec is invalid
+    :rtype: list[tuple[dict, dict | str]]
+    """
+    plan = plan_hosts(hosts)
+    scans = await asyncio.gather(*(scanner.scan_ports(name, sorted(ports)) for name, ports in plan.items()))
+    results = dict(zip(plan, scans))
+    checked = []
+    for host in hosts:
+        ports = host_ports(host)
+        if isinstance(ports, list):
+            ports = {port: results[host['Hosts'].lower()][port] for port in ports}
+        else:
+            utils.logger.warning("Monitoring: %s %s", host['Hosts'], ports)
+        checked.append((host, ports))
+    return checked
+
+
+async def check_targets(subscribers, hosts, pool=None):
+    """
+    Check all sites and hosts of a monitoring cycle concurrently.
+
+    :param subscribers: User IDs by site URL
+    :type subscribers: dict[str, list]
+    :param hosts: `Hosts` entities of all users
+    :type hosts: list[dict]
+    :param pool: Connection pool of the cycle, a new pool is used if omitted
+    :type pool: httpcore.AsyncConnectionPool, optional
+    :return: Subscribers, alert label and state by target name
+    :rtype: dict[str, tuple[list, str, dict]]
+    """
+    sites, host_results = await asyncio.gather(check_sites(list(subscribers), pool=pool), scan_hosts(hosts))
+    targets = {}
+    for url, probe in sites.items():
+        targets[f"site_{url}"] = (subscribers[url], url, site_state(probe))
+    for host, ports in host_results:
+        utils.logger.info("Monitoring: %s %s %s", host['Hosts'], host['port'], host['state'])
+        targets[host_name(host)] = (
+            [host['uid']], f"{host['Hosts']} {host['state']}", host_state(host, ports))
+    return targets
+
+
+def host_name(host):
+    """
+    Get the target name of a monitored host.
+
+    :param host: `Hosts` entity
+    :type host: dict
+    :return: Target name
+    :rtype: str
+    """
+    return f"host_{host['uid']}_{host['Hosts']}_{host['state']}"
+
+
+def due(names, previous, now):
+    """
+    Find the targets due for a check, most overdue first.
+
+    Targets without a saved state are due at once.
+
+    :param names: Names of all targets
+    :type names: Iterable[str]
+    :param previous: Saved state by target name
+    :type previous: dict
+    :param now: Start of the cycle
+    :type now: datetime
+    :return: Names of the due targets
+    :rtype: list[str]
+    """
+    never = datetime.min.replace(tzinfo=timezone.utc)
+    next_due = {name: previous.get(name, {}).get('next_due', never) for name in names}
+    return sorted((name for name, when in next_due.items() if when <= now), key=next_due.get)
+
+
+def schedule(previous, current, now):
+    """
+    Merge the check results into the saved states and set the next due time.
+
+    `time` keeps the time of the last up/down transition, `interval` keeps the
+    check interval of the target, `MONITOR_INTERVAL` by default.
+
+    :param previous: Saved state by target name
+    :type previous: dict
+    :param current: State of this cycle by target name
+    :type current: dict
+    :param now: Start of the cycle
+    :type now: datetime
+    :return: States to save by target name
+    :rtype: dict
+    """
+    states = {}
+    for name, state in current.items():
+        saved = previous.get(name, {})
+        interval = saved.get('interval', INTERVAL)
+        since = saved.get('time', state['time']) if saved.get('up', True) == state['up'] else state['time']
+        states[name] = {**state, 'time': since, 'interval': interval,
+                        'next_due': now + timedelta(seconds=interval)}
+    return states
+
+
+async def check_batch(batch, subscribers, hosts, previous, pool=None):
+    """
+    Check a batch of due targets and find their transitions.
+
+    :param batch: Names of the due targets
+    :type batch: list[str]
+    :param subscribers: User IDs by site URL
+    :type subscribers: dict[str, list]
+    :param hosts: `Hosts` entity by target name
+    :type hosts: dict[str, dict]
+    :param previous: Saved state by target name
+    :type previous: dict
+    :param pool: Connection pool of the cycle, a new pool is used if omitted
+    :type pool: httpcore.AsyncConnectionPool, optional
+    :return: State of this cycle by target name and the alerts of the batch
+    :rtype: tuple[dict, list[tuple[int, str]]]
+    """
+    names = set(batch)
+    targets = await check_targets({url: uids for url, uids in subscribers.items() if f"site_{url}" in names},
+                                  [hosts[name] for name in batch if name in hosts], pool)
+    current = {name: state for name, (_, _, state) in targets.items()}
+    for name in current:
+        metrics.TARGETS_CHECKED.labels(name.split("_", 1)[0]).inc()
+    changed = changes(previous, current)
+    alerts = [(uid, alert(label, changed[name]))
+              for name, (uids, label, _) in targets.items() if name in changed for uid in uids]
+    return current, alerts
+
+
+async def load_due(names, states, now):
+    """
+    Read the due states, drop the states of removed targets and queue the due targets.
+
+    :param names: Names of all targets
+    :type names: list[str]
+    :param states: Monitor state DB
+    :type states: db.Async
+    :param now: Start of the cycle
+    :type now: datetime
+    :return: Saved state by due target name and the names of the due targets, most overdue first
+    :rtype: tuple[dict, list[str]]
+    """
+    known = await states.qselect_names()
+    stale = known.difference(names)
+    if stale:
+        utils.logger.info("Monitoring: dropping %s stale states", len(stale))
+        await states.qdelete_many(list(stale))
+    previous = await states.qselect_due(now, DUE_LIMIT)
+    return previous, due([name for name in names if name in previous or name not in known], previous, now)
+
+
+async def cycle(subscribers, hosts, states, budget=BUDGET):
+    """
+    Check the due targets within a time budget.
+
+    Only the states due for a check are read, at most `MONITOR_DUE_LIMIT` of
+    them, and the states of deleted sites and hosts are dropped. Due targets
+    are checked in batches of `MONITOR_BATCH`, most overdue first.
+    No batch starts after the budget is used, the targets left keep their
+    due time and are checked first by the next cycle. All batches share one
+    connection pool.
+
+    :param subscribers: User IDs by site URL
+    :type subscribers: dict[str, list]
+    :param hosts: `Hosts` entities of all users
+    :type hosts: list[dict]
+    :param states: Monitor state DB
+    :type states: db.Async
+    :param budget: Time budget in seconds, defaults to `MONITOR_BUDGET`
+    :type budget: float, optional
+    :return: Pairs of user ID and alert line
+    :rtype: list[tuple[int, str]]
+    """
+    deadline = time.monotonic() + budget
+    now = datetime.now(timezone.utc)
+    host_names = {host_name(host): host for host in hosts}
+    names = [f"site_{url}" for url in subscribers] + list(host_names)
+    previous, queue = await load_due(names, states, now)
+
+    alerts = []
+    async with connection_pool() as pool:
+        for i in range(0, len(queue), BATCH):
+            if time.monotonic() >= deadline:
+                utils.logger.info("Monitoring budget used, %s targets left", len(queue) - i)
+                break
+            current, batch_alerts = await check_batch(queue[i:i + BATCH], subscribers, host_names, previous, pool)
+            alerts.extend(batch_alerts)
+            await states.qinsert_many(schedule(previous, current, now))
+    return alerts
+
+
+def site_state(probe):
+    """
+    Build the monitoring state of a site from its probe.
+
+    :param probe: Probe of the site, an empty result means the site is up
+    :type probe: Probe
+    :return: State with `up`, `detail`, `time`, phase `timings` and `cert_expires`
+    :rtype: dict
+    """
+    return {'up': not probe.result, 'detail': f"Error:{probe.result}" if probe.result else '',
+            'time': datetime.now(timezone.utc), 'timings': probe.timings, 'cert_expires': probe.cert_expires}
+
+
+def host_state(host, ports):
+    """
+    Build the monitoring state of a host from its port statuses.
+
+    The host is down when a port is not in the state the user expects, or
+    when its port spec could not be parsed.
+
+    :param host: `Hosts` entity
+    :type host: dict
+    :param ports: Status of the host's ports, or the error text of an invalid port spec
+    :type ports: dict | str
+    :return: State with `up`, `detail` and `time`
+    :rtype: dict
+    """
+    if isinstance(ports, str):
+        return {'up': False, 'detail': f"Error:{ports}", 'time': datetime.now(timezone.utc)}
+    unexpected = {"open": "closed", "closed": "open"}.get(host['state'])
+    wrong = [f"{port}: {PORT_MARKS.get(status, status)}" for port, status in ports.items() if status == unexpected]
+    return {'up': not wrong, 'detail': '\n'.join(wrong), 'time': datetime.now(timezone.utc)}
+
+
+def changes(previous, current):
+    """
+    Find the targets whose state flipped between up and down.
+
+    A target without a previous state counts as up, so it is reported only when down.
+
+    :param previous: Saved state by target name
+    :type previous: dict
+    :param current: State of this cycle by target name
+    :type current: dict
+    :return: Current state of the changed targets
+    :rtype: dict
+    """
+    return {name: state for name, state in current.items()
+            if state['up'] != previous.get(name, {'up': True})['up']}
+
+
+def alert(target, state):
+    """
+    Format an alert line for a target transition.
+
+    :param target: Site URL or host description
+    :type target: str
+    :param state: New state of the target
+    :type state: dict
+    :return: Alert line
+    :rtype: str
+    """
+    if state['up']:
+        return f"🟢 UP {target}"
+    return f"🔴 DOWN {target}\n{state['detail']}"
+
+
+def digest(alerts):
+    """
+    Merge the alerts of a cycle into one message per user.
+
+    :param alerts: Pairs of user ID and alert line
+    :type alerts: Iterable[tuple[int, str]]
+    :return: Message by user ID
+    :rtype: dict
+    """
+    lines = {}
+    for uid, line in alerts:
+        lines.setdefault(uid, []).append(line)
+    return {uid: '\n\n'.join(user_lines) for uid, user_lines in lines.items()}
@@ -0,0 +1,150 @@
+# MIT License
+#
+# Copyright (c) 2024 carpaty https://github.com/carpaty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# -*- coding: utf-8 -*-
+
+"""
+Caching DNS resolver of the monitoring engine
+"""
+
+import asyncio
+import functools
+import ipaddress
+import os
+import socket
+import time
+from collections import namedtuple
+
+import lru
+import metrics
+
+CACHE_SIZE = int(os.environ.get('DNS_CACHE_SIZE', 4096))
+CACHE_TTL = float(os.environ.get('DNS_CACHE_TTL', 300))
+MIN_TTL = float(os.environ.get('DNS_MIN_TTL', 30))
+
+Resolved = namedtuple('Resolved', ['addresses', 'ttl'])
+
+
+class Cache(lru.ResultCache):
+    """
+    Resolved addresses kept for the TTL of their DNS records, between `DNS_MIN_TTL` and `DNS_CACHE_TTL`.
+    """
+
+    def lifetime(self, value):
+        return min(max(value.ttl, MIN_TTL), self.ttl)
+
+
+@functools.cache
+def get_cache():
+    """
+    Get the resolver cache, creating it and exporting its lookups on first use.
+
+    :return: Resolver cache
+    :rtype: Cache
+    """
+    cache = Cache(CACHE_SIZE, CACHE_TTL)
+    metrics.cache_lookups('itb_dns_cache_lookups', "Hostname lookups of the monitoring resolver by cache result",
+                          cache)
+    return cache
+
+
+@functools.cache
+def dnspython():
+    """
+    Import dnspython on first use.
+
+    :return: The ``dns`` package, None if dnspython is not installed
+    :rtype: module | None
+    """
+    try:
+        import dns.asyncresolver  # pylint: disable=import-outside-toplevel
+        import dns.exception  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+    return dns
+
+
+async def query(dns, host):
+    """
+    Resolve a hostname with dnspython, reading the TTL of the records.
+
+    :param dns: The ``dns`` package
+    :type dns: module
+    :param host: Hostname
+    :type host: str
+    :return: IPv4 addresses first, then IPv6, and the smallest record TTL
+    :rtype: Resolved
+    """
+    answers = await asyncio.gather(dns.asyncresolver.resolve(host, "A", raise_on_no_answer=False),
+                                   dns.asyncresolver.resolve(host, "AAAA", raise_on_no_answer=False))
+    rrsets = [answer.rrset for answer in answers if answer.rrset is not None]
+    if not rrsets:
+        raise socket.gaierror(socket.EAI_NODATA, "No address associated with hostname")
+    return Resolved([rdata.address for rrset in rrsets for rdata in rrset], min(rrset.ttl for rrset in rrsets))
+
+
+async def lookup(host):
+    """
+    Resolve a hostname, falling back to the system resolver.
+
+    The system resolver also reads /etc/hosts but reports no TTL, its
+    results are kept for `DNS_CACHE_TTL`. IPv4 addresses come first.
+
+    :param host: Hostname
+    :type host: str
+    :return: Addresses of the host and their TTL
+    :rtype: Resolved
+    """
+    started = time.perf_counter()
+    dns = dnspython()
+    try:
+        if dns is not None:
+            try:
+                return await query(dns, host)
+            except dns.exception.DNSException:
+                pass
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        infos.sort(key=lambda info: info[0] != socket.AF_INET)
+        return Resolved(list(dict.fromkeys(info[4][0] for info in infos)), CACHE_TTL)
+    except OSError:
+        metrics.DNS_ERRORS.inc()
+        raise
+    finally:
+        metrics.DNS_SECONDS.observe(time.perf_counter() - started)
+
+
+async def resolve(host):
+    """
+    Get the addresses of a host from the cache, resolving it once for all concurrent callers.
+
+    :param host: Hostname or IP address
+    :type host: str
+    :return: Addresses of the host
+    :rtype: list[str]
+    :raises socket.gaierror: If the hostname cannot be resolved
+    """
+    try:
+        return [str(ipaddress.ip_address(host.strip("[]")))]
+    except ValueError:
+        pass
+    resolved = await get_cache().fetch(host.lower(), lookup, host.lower())
+    return resolved.addresses
@@ -0,0 +1,135 @@
+# MIT License
+#
+# Copyright (c) 2024 carpaty https://github.com/carpaty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# -*- coding: utf-8 -*-
+
+"""
+Asynchronous TCP connect scanner
+"""
+
+import asyncio
+import os
+import socket
+
+import resolver
+
+CONCURRENCY = int(os.environ.get('SCAN_CONCURRENCY', 500))
+HOST_CONCURRENCY = int(os.environ.get('SCAN_HOST_CONCURRENCY', 100))
+TIMEOUT = float(os.environ.get('SCAN_TIMEOUT', 1))
+
+_limit = asyncio.Semaphore(CONCURRENCY)
+_host_limits = {}
+
+
+def parse_ports(ports):
+    """
+    Expand a port specification into a list of ports.
+
+    :param ports: Comma-separated list of ports or port ranges (e.g., 22,80,8000-8010)
+    :type ports: str
+    :return: Ports in the order they are specified
+    :rtype: list[int]
+    """
+    port_list = []
+    for port_range in ports.split(','):
+        if '-' in port_range:
+            start, end = map(int, port_range.split('-'))
+            port_list.extend(range(start, end + 1))
+        else:
+            port_list.append(int(port_range))
+    return port_list
+
+
+async def probe(host, port, host_limit, timeout=TIMEOUT):
+    """
+    Try to open a TCP connection to a port.
+
+    :param host: Hostname or IP address
+    :type host: str
+    :param port: Port number
+    :type port: int
+    :param host_limit: Semaphore bounding the probes in flight for this host
+    :type host_limit: asyncio.Semaphore
+    :param timeout: Timeout of the connection attempt in seconds
+    :type timeout: float
+    :return: Port status: "open", "closed" or the error text
+    :rtype: str
+    """
+    async with host_limit, _limit:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        except (socket.gaierror, OverflowError, ValueError) as err:
+            return f"Error: {err}"
+        except (OSError, asyncio.TimeoutError):
+            return "closed"
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return "open"
+
+
+async def scan(host, ports):
+    """
+    Scan ports of a host concurrently.
+
+    :param host: Hostname or IP address
+    :type host: str
+    :param ports: Comma-separated list of ports or port ranges
+    :type ports: str
+    :return: Port status for each port scanned
+    :rtype: dict
+    """
+    return await scan_ports(host, parse_ports(ports))
+
+
+async def scan_ports(host, port_list):
+    """
+    Scan a list of ports of a host concurrently.
+
+    Probes are bounded by a global and a per-host semaphore, so several hosts
+    and users can scan at the same time without exhausting sockets. The host
+    is resolved once through the resolver cache, every probe uses its address.
+
+    :param host: Hostname or IP address
+    :type host: str
+    :param port_list: Ports to scan
+    :type port_list: list[int]
+    :return: Port status for each port scanned
+    :rtype: dict
+    """
+    try:
+        address = (await resolver.resolve(host))[0]
+    except socket.gaierror as err:
+        return {port: f"Error: {err}" for port in port_list}
+    host_limit, users = _host_limits.get(host, (asyncio.Semaphore(HOST_CONCURRENCY), 0))
+    _host_limits[host] = (host_limit, users + 1)
+    try:
+        results = await asyncio.gather(*(probe(address, port, host_limit) for port in port_list))
+    finally:
+        host_limit, users = _host_limits[host]
+        if users > 1:
+            _host_limits[host] = (host_limit, users - 1)
+        else:
+            del _host_limits[host]
+    return dict(zip(port_list, results))
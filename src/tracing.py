@@ -0,0 +1,233 @@
+# MIT License
+#
+# Copyright (c) 2024 carpaty https://github.com/carpaty
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# -*- coding: utf-8 -*-
+
+"""
+Update tracing and profiling
+"""
+
+import contextvars
+import cProfile
+import functools
+import inspect
+import io
+import logging
+import os
+import pstats
+import random
+import time
+
+from telegram.request import HTTPXRequest
+
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+TRACE_SLOW = float(os.environ.get('TRACE_SLOW', 1))
+PROFILE_RATE = float(os.environ.get('PROFILE_RATE', 0))
+PROFILE_TOP = 25
+
+settings = {'enabled': TRACE_ENABLED, 'slow': TRACE_SLOW, 'profile_rate': PROFILE_RATE}
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('trace', default=None)
+_profiling = {'active': False}
+
+
+class Trace:
+    """
+    Timed spans of one update.
+
+    :ivar name: Name of the update
+    :vartype name: str
+    :ivar started: Start time, `time.perf_counter` seconds
+    :vartype started: float
+    :ivar spans: Total seconds and number of calls by span name
+    :vartype spans: dict[str, list]
+    :ivar done: True once the update is processed, later spans are ignored
+    :vartype done: bool
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.done = False
+
+    def add(self, name, elapsed):
+        """
+        Record a finished span.
+
+        :param name: Span name
+        :type name: str
+        :param elapsed: Duration, seconds
+        :type elapsed: float
+        """
+        if not self.done:
+            total = self.spans.setdefault(name, [0.0, 0])
+            total[0] += elapsed
+            total[1] += 1
+
+    def breakdown(self):
+        """
+        Format the spans, longest first.
+
+        :return: One line per span name
+        :rtype: str
+        """
+        spans = sorted(self.spans.items(), key=lambda item: item[1][0], reverse=True)
+        return "\n".join(f"  {name}: {total:.3f} s x{count}" for name, (total, count) in spans)
+
+
+class Span:
+    """
+    Context manager timing one span of the current trace.
+    """
+
+    __slots__ = ('trace', 'name', 'started')
+
+    def __init__(self, current, name):
+        self.trace = current
+        self.name = name
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, time.perf_counter() - self.started)
+
+
+class _NoSpan:
+    """
+    Context manager used outside of a trace.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return None
+
+
+NO_SPAN = _NoSpan()
+
+
+def span(name):
+    """
+    Time a block as a span of the current update.
+
+    Outside of a traced update this is a shared no-op context manager.
+
+    :param name: Span name
+    :type name: str
+    :return: Context manager
+    :rtype: Span | _NoSpan
+    """
+    current = _current.get()
+    if current is None:
+        return NO_SPAN
+    return Span(current, name)
+
+
+def traced(name=None):
+    """
+    Decorate a function or coroutine function to run as a span.
+
+    :param name: Span name, defaults to ``module.function``
+    :type name: str, optional
+    :return: Decorator
+    :rtype: callable
+    """
+    def decorator(func):
+        label = name or f"{func.__module__}.{func.__qualname__}"
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(label):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def run(name, coroutine):
+    """
+    Await the processing of an update as a trace.
+
+    Updates slower than the `slow` setting are logged with their span breakdown.
+    A `profile_rate` percent of updates is run under cProfile, one at a time;
+    the profile covers everything the event loop runs meanwhile.
+
+    :param name: Name of the update
+    :type name: str
+    :param coroutine: Processing of the update
+    :type coroutine: Awaitable
+    """
+    profile = settings['profile_rate'] > 0 and not _profiling['active'] \
+        and random.random() * 100 < settings['profile_rate']
+    if not settings['enabled'] and not profile:
+        await coroutine
+        return
+    current = Trace(name)
+    token = _current.set(current)
+    profiler = None
+    if profile:
+        _profiling['active'] = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        await coroutine
+    finally:
+        if profiler:
+            profiler.disable()
+            _profiling['active'] = False
+        _current.reset(token)
+        current.done = True
+        elapsed = time.perf_counter() - current.started
+        if settings['enabled'] and elapsed >= settings['slow']:
+            logger.warning("Slow %s: %.3f s\n%s", name, elapsed, current.breakdown())
+        if profiler:
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_TOP)
+            logger.info("Profile of %s: %.3f s\n%s", name, elapsed, stream.getvalue())
+
+
+class Request(HTTPXRequest):
+    """
+    Telegram Bot API request recording every API call as a span.
+    """
+
+    async def do_request(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+            self, url, method, request_data=None, read_timeout=None,
+            write_timeout=None, connect_timeout=None, pool_timeout=None):
+        with span(f"telegram.{url.rsplit('/', 1)[-1]}"):
+            return await super().do_request(url, method, request_data=request_data,
+                                            read_timeout=read_timeout, write_timeout=write_timeout,
+                                            connect_timeout=connect_timeout, pool_timeout=pool_timeout)
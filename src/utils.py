@@ -23,13 +23,17 @@
 # -*- coding: utf-8 -*-
 """ Util module """
 
+import hashlib
+import json
 import logging
 import uuid
 import re
 import os
-import yaml
-import telegram
+import tempfile
 import db
+import dispatcher
+import lru
+import tracing
 
 VERSION = "0.0.1"
 
@@ -38,14 +42,28 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 
 logger = logging.getLogger(__name__)
 
-cache = db.Cache()
+cache = db.AsyncCache(db.Cache())
+users = db.Async(db.Sql())
 
-with open('menu.yaml', encoding="utf-8", mode="r") as f:
-    file = f.read()
-cfg = yaml.load(file, Loader=yaml.FullLoader)
+API_KEY_CACHE_SIZE = int(os.environ.get('API_KEY_CACHE_SIZE', 10000))
+API_KEY_TTL = float(os.environ.get('API_KEY_TTL', 3600))
+API_KEY_MISS_TTL = float(os.environ.get('API_KEY_MISS_TTL', 60))
+
+api_keys = lru.TTLCache(API_KEY_CACHE_SIZE, API_KEY_TTL)
+
+LOOKUP_CACHE_SIZE = int(os.environ.get('LOOKUP_CACHE_SIZE', 1024))
+LOOKUP_CACHE_TTL = float(os.environ.get('LOOKUP_CACHE_TTL', 600))
+
+lookups = lru.ResultCache(LOOKUP_CACHE_SIZE, LOOKUP_CACHE_TTL)
+MISSING = object()
+
+MENU_FILE = 'menu.yaml'
+MENU_CACHE = os.environ.get('MENU_CACHE', os.path.join(tempfile.gettempdir(), 'menu.cache.json'))
 
 KEY = os.environ.get('TELEGRAM_TOKEN', "XXX")
 
+outbox = dispatcher.Dispatcher(KEY)
+
 EMOJI_PATTERN = re.compile(
     "^["
     "\U0001F1E0-\U0001F1FF"  # flags (iOS)
@@ -64,86 +82,106 @@ EMOJI_PATTERN = re.compile(
 )
 
 
-async def post_tg(uid, tg_text) -> None:
+def compile_menu(tree):
     """
-    Send a message to a user on Telegram.
-
-    :param uid: User ID
-    :type uid: int
-    :param tg_text: Text message to be sent
-    :type tg_text: str
-    """
-    bot = telegram.Bot(token=KEY)
-    logger.info("Message '%s' sent to %s", tg_text, uid)
-    await bot.send_message(chat_id=uid, text=tg_text)
+    Compile the menu tree into a flat index.
 
+    Every node label is mapped to its parent, child labels and inline buttons,
+    every call is mapped to its button name, description and parent node, so
+    menu navigation does not need to walk the tree.
 
-def find_key(d, target_key, parent_key=None):
+    :param tree: Menu tree loaded from menu.yaml
+    :type tree: dict
+    :return: Menu index with `root`, `nodes`, `calls` and the original `tree`
+    :rtype: dict
     """
-    Find a key in a nested dictionary.
-
-    :param d: The dictionary to search
-    :type d: dict
-    :param target_key: The key to find
-    :type target_key: str
-    :param parent_key: The parent key, defaults to None
-    :type parent_key: str, optional
-    :yield: Parent key
-    :rtype: generator
+    nodes = {}
+    calls = {}
+
+    def walk(branch, parent):
+        for label, value in branch.items():
+            node = {'parent': parent, 'children': [], 'inline': []}
+            nodes[label] = node
+            if isinstance(value, dict):
+                node['children'] = list(value)
+                walk(value, label)
+            elif isinstance(value, list):
+                for button in value:
+                    node['inline'].append({'name': button['name'], 'call': button['call']})
+                    calls.setdefault(button['call'], {
+                        'name': button['name'], 'desc': button.get('desc'), 'parent': label})
+
+    walk(tree, None)
+    return {'root': list(tree), 'nodes': nodes, 'calls': calls, 'tree': tree}
+
+
+def load_menu(path=MENU_FILE, cache_path=MENU_CACHE):
     """
-    for k, v in d.items():
-        if k == target_key:
-            yield parent_key
-        if isinstance(v, dict):
-            yield from find_key(v, target_key, k)
+    Load the compiled menu index.
 
+    The index is read from the on-disk cache when it was compiled from the same
+    menu.yaml content, otherwise menu.yaml is parsed, compiled and cached.
 
-def find_desc(val, dictionary, desc=''):
+    :param path: Path to menu.yaml, defaults to `MENU_FILE`
+    :type path: str, optional
+    :param cache_path: Path to the compiled index, defaults to `MENU_CACHE`
+    :type cache_path: str, optional
+    :return: Menu index
+    :rtype: dict
     """
-    Find a description in a nested dictionary.
-
-    :param val: The value to find
-    :type val: any
-    :param dictionary: The dictionary to search
-    :type dictionary: dict
-    :param desc: The description key, defaults to ''
-    :type desc: str, optional
-    :yield: Description
-    :rtype: generator
+    with open(path, mode="rb") as f:
+        raw = f.read()
+    digest = hashlib.sha1(raw).hexdigest()
+    try:
+        with open(cache_path, encoding="utf-8", mode="r") as f:
+            index = json.load(f)
+        if index.get('digest') == digest:
+            return index
+    except (OSError, ValueError):
+        pass
+
+    import yaml  # pylint: disable=import-outside-toplevel
+    index = compile_menu(yaml.load(raw, Loader=yaml.FullLoader))
+    index['digest'] = digest
+    try:
+        with open(f"{cache_path}.tmp", encoding="utf-8", mode="w") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(f"{cache_path}.tmp", cache_path)
+    except OSError as e:
+        logger.info("Menu cache %s is not saved: %s", cache_path, e)
+    return index
+
+
+MENU = load_menu()
+cfg = MENU['tree']
+
+
+def menu_desc(call):
     """
-    for _, v in dictionary.items():
-        if v == val:
-            yield v
-        elif isinstance(v, dict):
-            yield from find_desc(val, v, desc)
-        elif isinstance(v, list):
-            for d in v:
-                for _ in find_desc(val, d, desc):
-                    yield d[desc]
-
-
-def find(key, dictionary):
+    Get the description of a menu call.
+
+    :param call: Name of the call
+    :type call: str
+    :return: Description of the call
+    :rtype: str
     """
-    Find a key in a nested dictionary or list.
-
-    :param key: The key to find
-    :type key: str
-    :param dictionary: The dictionary to search
-    :type dictionary: dict
-    :yield: Value associated with the key
-    :rtype: generator
+    return MENU['calls'][call]['desc']
+
+
+@tracing.traced()
+async def post_tg(uid, tg_text) -> None:
     """
-    for k, v in dictionary.items():
-        if k == key:
-            yield v
-        elif isinstance(v, dict):
-            yield from find(key, v)
-        elif isinstance(v, list):
-            for d in v:
-                yield from find(key, d)
+    Send a message to a user on Telegram through the shared dispatcher.
 
+    :param uid: User ID
+    :type uid: int
+    :param tg_text: Text message to be sent
+    :type tg_text: str
+    """
+    await outbox.send(uid, tg_text)
 
-def check_state(uid):
+
+async def check_state(uid):
     """
     Check the state in the Position DB.
 
@@ -152,10 +190,10 @@ def check_state(uid):
     :return: Database result
     :rtype: iteration
     """
-    return cache.qselect(f"state_{uid}")
+    return await cache.qselect(f"state_{uid}")
 
 
-def update_state(uid, state):
+async def update_state(uid, state):
     """
     Update the state in the Position DB.
 
@@ -165,10 +203,10 @@ def update_state(uid, state):
     :type state: str
     """
     state = {'current': state}
-    cache.qinsert(f"state_{uid}", state)
+    await cache.qinsert(f"state_{uid}", state)
 
 
-def check_button(uid):
+async def check_button(uid):
     """
     Check the button state in the Position DB.
 
@@ -177,10 +215,10 @@ def check_button(uid):
     :return: Current button state
     :rtype: str
     """
-    return cache.qselect(f"button_{uid}")
+    return await cache.qselect(f"button_{uid}")
 
 
-def update_button(uid, state):
+async def update_button(uid, state):
     """
     Update the button state in the Position DB.
 
@@ -190,42 +228,10 @@ def update_button(uid, state):
     :type state: str
     """
     state = {'current': state}
-    cache.qinsert(f"button_{uid}", state)
-
-
-def find_all_call(d, tag):
-    """
-    Find all calls from the data.
-
-    :param d: YAML data
-    :type d: dict
-    :param tag: Name of the item
-    :type tag: str
-    :yield: Item
-    :rtype: generator
-    """
-    for v in d.values():
-        if v == tag:
-            yield v
-        elif isinstance(v, dict):
-            yield from find_all_call(v, tag)
-        elif isinstance(v, list):
-            for item in v:
-                if isinstance(item, dict) and tag in item:
-                    yield item[tag]
-
-
-def call_pattern():
-    """
-    Get all call functions from menu.yaml.
-
-    :return: Regex pattern
-    :rtype: str
-    """
-    return re.compile(f"^({'|'.join(find_all_call(cfg, 'call'))})$")
+    await cache.qinsert(f"button_{uid}", state)
 
 
-def user_check(uid):
+async def user_check(uid):
     """
     Check if a user exists in the Users DB.
 
@@ -234,37 +240,65 @@ def user_check(uid):
     :return: Database result
     :rtype: iteration
     """
-    sql = db.Sql()
-    res = sql.qselect(uid)
-    return res
+    return await users.qselect(uid)
 
 
-def user_insert(uid):
+async def user_insert(uid):
     """
     Insert a new user into the Users DB.
 
+    The new API key replaces any cached miss in the API key index.
+
     :param uid: User ID
     :type uid: int
     """
-    sql = db.Sql()
-    sql.qinsert(uid, uuid.uuid4().hex)
+    user_hash = uuid.uuid4().hex
+    await users.qinsert(uid, user_hash)
+    api_keys.set(user_hash, uid)
 
 
-def getuidbyhash(user_hash):
+async def getuidbyhash(user_hash):
     """
     Get the user ID by hash.
 
+    Lookups are served from the in-memory API key index, unknown keys are
+    cached for a shorter `API_KEY_MISS_TTL`.
+
     :param user_hash: User hash (UUID)
     :type user_hash: str
-    :return: User ID
-    :rtype: int
+    :return: User ID, None if the hash is unknown
+    :rtype: int | None
     """
-    sql = db.Sql()
-    res = list(sql.qselect_hash(user_hash))
-    return res[0].id
+    uid = api_keys.get(user_hash, MISSING)
+    if uid is MISSING:
+        uid = await users.qselect_uid(user_hash)
+        api_keys.set(user_hash, uid, None if uid else API_KEY_MISS_TTL)
+    return uid
 
 
-def gethashbyuid(uid):
+async def getuidsbyhash(user_hashes):
+    """
+    Get the user IDs of several hashes.
+
+    Hashes missing from the API key index are resolved with batched queries.
+
+    :param user_hashes: User hashes (UUID)
+    :type user_hashes: Iterable[str]
+    :return: User ID by hash, None for unknown hashes
+    :rtype: dict
+    """
+    uids = {user_hash: api_keys.get(user_hash, MISSING) for user_hash in set(user_hashes)}
+    missing = [user_hash for user_hash, uid in uids.items() if uid is MISSING]
+    if missing:
+        found = await users.qselect_uids(missing)
+        for user_hash in missing:
+            uid = found.get(user_hash)
+            api_keys.set(user_hash, uid, None if uid else API_KEY_MISS_TTL)
+            uids[user_hash] = uid
+    return uids
+
+
+async def gethashbyuid(uid):
     """
     Get the hash by user ID.
 
@@ -273,6 +307,4 @@ def gethashbyuid(uid):
     :return: User hash (UUID)
     :rtype: str
     """
-    sql = db.Sql()
-    res = sql.qselect(uid)
-    return res
+    return await users.qselect(uid)